@@ -3,11 +3,16 @@ import boto3
 import base64
 import uuid
 import os
+import time
 from datetime import datetime
 import logging
-from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+from image_records import (
+    DELETION_MODE_INDEX_FIELD, SOFT_DELETE_FIELDS, TRANSACT_WRITE_SIZE, WRITE_WORKERS,
+    batch_get_items, chunk_list, enqueue_purge, get_bulk_image_ids, get_image_share_tokens,
+    get_shares_of_images, transact_deletion_mode_chunk, transact_set_deletion_mode
+)
 
-s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
 
 logger = logging.getLogger()
@@ -21,6 +26,173 @@ myHeaders = {
     'Access-Control-Allow-Credentials': 'true'
 }
 
+SOFT_DELETE_RETENTION_DAYS = int(os.environ.get('SOFT_DELETE_RETENTION_DAYS', 30))
+
+
+def soft_delete_fields(user_id):
+    return {
+        DELETION_MODE_INDEX_FIELD: f"{user_id}#soft",
+        'soft_deleted': 'true',
+        'purge_at': int(time.time()) + SOFT_DELETE_RETENTION_DAYS * 24 * 60 * 60
+    }
+
+
+def previous_deletion_fields(item):
+    # what a row marked pending_delete had before, for putting it back
+    return {name: item[name] for name in SOFT_DELETE_FIELDS + (DELETION_MODE_INDEX_FIELD,) if name in item}
+
+
+def body_error(message):
+    return {
+        'statusCode': 400,
+        'headers': myHeaders,
+        'body': json.dumps({'error': message})
+    }
+
+
+def hard_delete(user_id, image_id):
+    # a single conditional write marks the image, the purge worker removes
+    # the object, the shares and the row later
+    logger.info("it is a hard deletion...")
+    user_images_table = dynamodb.Table(os.environ['USER_IMAGES_TABLE'])
+    key = {
+        'user_id': user_id,
+        'image_id': image_id
+    }
+
+    try:
+        response = user_images_table.update_item(
+            Key=key,
+            UpdateExpression='SET deletion_mode = :pending REMOVE soft_deleted, purge_at, user_deletion_mode',
+            ConditionExpression='attribute_exists(user_id) AND (attribute_not_exists(deletion_mode) OR deletion_mode <> :pending)',
+            ExpressionAttributeValues={
+                ':pending': 'pending_delete'
+            },
+            ReturnValues='ALL_OLD',
+            ReturnValuesOnConditionCheckFailure='ALL_OLD'
+        )
+    except user_images_table.meta.client.exceptions.ConditionalCheckFailedException as e:
+        if 'Item' not in e.response:
+            return {
+                'statusCode': 404,
+                'headers': myHeaders,
+                'body': json.dumps({'error': 'Image not found'})
+            }
+        logger.info("hard deletion already scheduled")
+    else:
+        item = response['Attributes']
+        if enqueue_purge([item]):
+            # put the image back rather than leave it hidden with nothing to purge it
+            transact_set_deletion_mode(
+                os.environ['USER_IMAGES_TABLE'],
+                [key],
+                item.get('deletion_mode', 'none'),
+                previous_deletion_fields(item)
+            )
+            raise Exception("could not schedule the hard deletion")
+
+    return {
+        'statusCode': 200,
+        'headers': myHeaders,
+        'body': json.dumps({
+            'message': f'Successfully deleted {image_id} - using hard deletion'
+        })
+    }
+
+
+def hard_delete_chunk(table_name, items):
+    # one transaction of images goes pending_delete and is queued straight
+    # away, so a chunk that fails never leaves another one hidden with
+    # nothing to purge it. An image that went pending_delete since it was read
+    # is already queued and is skipped. Returns the image ids that were not scheduled
+    keys = [{'user_id': item['user_id'], 'image_id': item['image_id']} for item in items]
+    try:
+        skipped_keys = transact_deletion_mode_chunk(
+            table_name,
+            keys,
+            'pending_delete',
+            remove_fields=SOFT_DELETE_FIELDS + (DELETION_MODE_INDEX_FIELD,),
+            except_mode='pending_delete'
+        )
+    except Exception as e:
+        # the transaction is all or nothing, none of these were marked
+        logger.error(f"Error marking {len(items)} images for hard deletion: {str(e)}")
+        return [item['image_id'] for item in items]
+
+    skipped_ids = {key['image_id'] for key in skipped_keys}
+    items = [item for item in items if item['image_id'] not in skipped_ids]
+    failed_ids = enqueue_purge(items)
+    for item in items:
+        if item['image_id'] in failed_ids:
+            # put the image back rather than leave it hidden with nothing to purge it
+            transact_deletion_mode_chunk(
+                table_name,
+                [{'user_id': item['user_id'], 'image_id': item['image_id']}],
+                item.get('deletion_mode', 'none'),
+                previous_deletion_fields(item)
+            )
+    return failed_ids
+
+
+def bulk_delete(event, user_id):
+    logger.info("bulk delete started...")
+
+    image_ids, body, error = get_bulk_image_ids(event)
+    if error:
+        return body_error(error)
+
+    deletion_type = body.get('deletion_type')
+    if deletion_type not in ["soft", "hard"]:
+        return body_error('Invalid deletion_type parameter')
+
+    logger.info(f"Deleting {len(image_ids)} images - using {deletion_type} deletion")
+
+    user_images_table_name = os.environ['USER_IMAGES_TABLE']
+    image_sharing_table = dynamodb.Table(os.environ['IMAGE_SHARING_TABLE'])
+
+    items = batch_get_items(
+        user_images_table_name,
+        [{'user_id': user_id, 'image_id': image_id} for image_id in image_ids],
+        'user_id, image_id, s3Key, renditions, content_hash, duplicate_of, deletion_mode, soft_deleted, purge_at, user_deletion_mode'
+    )
+    # images already waiting for the purge worker are gone as far as the user is concerned
+    items = [item for item in items if item.get('deletion_mode') != 'pending_delete']
+    found_ids = [item['image_id'] for item in items]
+    not_found_ids = sorted(set(image_ids) - set(found_ids))
+
+    image_keys = [{'user_id': user_id, 'image_id': image_id} for image_id in found_ids]
+    failed_ids = []
+
+    if deletion_type == 'soft':
+        transact_set_deletion_mode(user_images_table_name, image_keys, 'soft', soft_delete_fields(user_id))
+        transact_set_deletion_mode(
+            os.environ['IMAGE_SHARING_TABLE'],
+            get_shares_of_images(image_sharing_table, user_id, found_ids),
+            'soft'
+        )
+
+    elif deletion_type == 'hard':
+        # mark everything pending_delete, the purge worker does the rest
+        with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+            failed_chunks = pool.map(
+                lambda chunk: hard_delete_chunk(user_images_table_name, chunk),
+                chunk_list(items, TRANSACT_WRITE_SIZE)
+            )
+            failed_ids = [image_id for chunk_failed_ids in failed_chunks for image_id in chunk_failed_ids]
+
+    deleted_ids = [image_id for image_id in found_ids if image_id not in failed_ids]
+
+    return {
+        'statusCode': 200,
+        'headers': myHeaders,
+        'body': json.dumps({
+            'message': f'Successfully deleted {len(deleted_ids)} images - using {deletion_type} deletion',
+            'deleted': deleted_ids,
+            'notFound': not_found_ids,
+            'failed': failed_ids
+        })
+    }
+
 
 def lambda_handler(event, context):
     logger.info("deleting image started...")
@@ -32,6 +204,9 @@ def lambda_handler(event, context):
 
         user_id = user_email # we are changing the user id to be the user email
 
+        if event.get('httpMethod') == 'POST':
+            return bulk_delete(event, user_id)
+
         image_id = None
 
          # Check if this is a shared image access
@@ -67,11 +242,13 @@ def lambda_handler(event, context):
             
         logger.info(f"Deletion type: {deletion_type}")
 
+        if deletion_type == 'hard':
+            return hard_delete(user_id, image_id)
+
         logger.info("Getting single image")
 
         user_images_table = dynamodb.Table(os.environ['USER_IMAGES_TABLE'])
         image_sharing_table = dynamodb.Table(os.environ['IMAGE_SHARING_TABLE'])
-        processed_images_s3_bucket = os.environ['PROCESSED_BUCKET']
     
         user_images_table_response = user_images_table.get_item(
             Key={
@@ -82,7 +259,7 @@ def lambda_handler(event, context):
 
         logger.info(f"Response from user_images DynamoDB: {user_images_table_response}")
 
-        if 'Item' not in user_images_table_response:
+        if 'Item' not in user_images_table_response or user_images_table_response['Item'].get('deletion_mode') == 'pending_delete':
             return {
                 'statusCode': 404,
                 'headers': myHeaders,
@@ -91,68 +268,18 @@ def lambda_handler(event, context):
 
         user_images_table_item = user_images_table_response['Item']
 
-        image_sharing_table_response = image_sharing_table.scan()
-        logger.info(f"Response from DynamoDB: {image_sharing_table_response}")
-
-        # search in the image_sharing_table and delete object accordingly
-        try:
-            image_sharing_table_items = image_sharing_table_response.get('Items', [])
-        except Exception as e:
-            logger.error(f"Error getting the items {str(e)}")
-            image_sharing_table_items = []
-
-        if deletion_type == 'soft':
-            logger.info("it is a soft deletion...")
-            user_images_table_item['deletion_mode'] = 'soft'
-            logger.info("Updating item in the table...")
-            user_images_table.put_item(Item=user_images_table_item)
-
-
-        elif deletion_type == 'hard':
-            logger.info("it is a hard deletion...")
-
-            # delete from table
-            logger.info("deleting from table...")
-            user_images_table.delete_item(
-                Key={
-                    'user_id': user_id,
-                    'image_id': image_id
-                }
-            )
+        image_share_tokens = get_image_share_tokens(image_sharing_table, user_id, image_id)
 
-            theKey = user_images_table_item['s3Key']
-            logger.info(f"the s3 bucket Key => {theKey}")
-
-            # delete from s3
-            logger.info("deleting from s3...")
-            s3.delete_object(
-                Bucket=processed_images_s3_bucket,
-                Key=theKey
-            )
+        logger.info("it is a soft deletion...")
+        user_images_table_item['deletion_mode'] = 'soft'
+        user_images_table_item.update(soft_delete_fields(user_id))
+        logger.info("Updating item in the table...")
+        user_images_table.put_item(Item=user_images_table_item)
 
-        # delete from image_sharing_table
-        if len(image_sharing_table_items) != 0:
-            for item in image_sharing_table_items:
-                if item['image_id'] == image_id:
-                    if deletion_type == 'soft': 
-                        logger.info(f"Updating item in image_sharing_table: {item}")
-                        image_sharing_table.update_item(
-                            Key={
-                                'share_token': item['share_token']
-                            },
-                            UpdateExpression='SET deletion_mode = :val',
-                            ExpressionAttributeValues={
-                                ':val': 'soft'
-                            }
-                        )
-                    elif deletion_type == 'hard':
-                        logger.info(f"Deleting item from image_sharing_table: {item}")
-                        image_sharing_table.delete_item(
-                            Key={
-                                'share_token': item['share_token']
-                            }
-                        )
-                        logger.info(f"Deleted item from image_sharing_table: {item}")
+        # update the image's shares in image_sharing_table
+        share_keys = [{'share_token': share_token} for share_token in image_share_tokens]
+        logger.info(f"Updating {len(share_keys)} shares in image_sharing_table")
+        transact_set_deletion_mode(os.environ['IMAGE_SHARING_TABLE'], share_keys, 'soft')
         
         return {
             'statusCode': 200,
@@ -1,18 +1,42 @@
 import json
 import boto3
 import io
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, ImageOps, ExifTags, features
 from datetime import datetime
 import os
 import logging
-import requests
 import urllib.parse
+import time
+import tempfile
+import math
+import hashlib
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from functools import lru_cache
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from retry_policy import PermanentProcessingError, classify_error, backoff_delay, TRANSIENT, MAX_ATTEMPTS
 
-s3 = boto3.client('s3')
-dynamodb = boto3.resource('dynamodb')
-sns = boto3.client('sns')
-cognito = boto3.client('cognito-idp')
-sqs = boto3.client('sqs')
+# records of a batch are processed by this many threads, Pillow releases
+# the GIL while it decodes and encodes so they overlap with each other's I/O
+PROCESSING_WORKERS = int(os.environ.get('PROCESSING_WORKERS', 4))
+# independent network calls of one image (user lookup, uploads, cleanup)
+# run here, apart from the record workers so they never wait on each other
+IO_WORKERS = int(os.environ.get('IO_WORKERS', PROCESSING_WORKERS * 4))
+# threads of one S3 upload or download
+TRANSFER_CONCURRENCY = int(os.environ.get('TRANSFER_CONCURRENCY', 4))
+transfer_config = TransferConfig(max_concurrency=TRANSFER_CONCURRENCY)
+
+# every thread shares the clients, each record worker may have a download
+# and an upload running next to the io_pool calls. With fewer connections
+# than that, botocore drops and re-opens them (a new TLS handshake each time)
+client_config = Config(max_pool_connections=PROCESSING_WORKERS * TRANSFER_CONCURRENCY * 2 + IO_WORKERS)
+
+s3 = boto3.client('s3', config=client_config)
+sns = boto3.client('sns', config=client_config)
+cognito = boto3.client('cognito-idp', config=client_config)
+sqs = boto3.client('sqs', config=client_config)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
@@ -25,102 +49,462 @@ myHeaders = {
 }
 
 
-FONT_PATH = "/tmp/arialbd.ttf" 
-FONT_URL = "https://github.com/matomo-org/travis-scripts/raw/master/fonts/Arial_Bold.ttf"  # Publicly available Arial Bold font
+# bundled with the function (fonts/), so nothing is downloaded at runtime
+FONT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fonts', 'DejaVuSans-Bold.ttf')
+
+# a record only starts with this much of the invocation left, enough for one image
+MIN_START_MILLIS = int(os.environ.get('MIN_START_SECONDS', 60)) * 1000
+
+# lives as long as the container, so do the threads and their DynamoDB resources
+record_pool = ThreadPoolExecutor(max_workers=PROCESSING_WORKERS)
+
+# images in flight together must fit in this, defaults to 70% of the function memory
+PROCESSING_MEMORY_BUDGET = int(os.environ.get(
+    'PROCESSING_MEMORY_BUDGET_MB',
+    int(os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', 3000)) * 0.7
+)) * 1024 * 1024
+# decoded frame, rendition chain and encoder buffers per decoded pixel
+BYTES_PER_PIXEL_ESTIMATE = 8
+
+io_pool = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
+# downloads bigger than this are spooled to /tmp instead of memory
+SPOOL_MAX_SIZE = int(os.environ.get('SPOOL_MAX_SIZE', 16 * 1024 * 1024))
+# biggest original that is downloaded, every record worker may spool one to /tmp at once
+MAX_SOURCE_BYTES = int(os.environ.get('MAX_SOURCE_BYTES', 400 * 1024 * 1024))
+
+# most pixels decoded for one image, bigger JPEGs are decoded straight to a
+# 1/2, 1/4 or 1/8 scale, anything else over the budget is rejected
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 50 * 1000 * 1000))
+JPEG_DRAFT_MAX_SCALE = 8
+# nothing above this can be brought inside the budget, Pillow refuses to open it
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS * JPEG_DRAFT_MAX_SCALE ** 2
+
+# the start of the object is fetched to read the format and dimensions,
+# growing up to MAX_SNIFF_BYTES when the header is behind big metadata blocks
+SNIFF_BYTES = 64 * 1024
+MAX_SNIFF_BYTES = 1024 * 1024
+
+# long edge in pixels of the smaller copies made for the gallery, stored under renditions/<size>/<key>
+RENDITION_SIZES = [int(size) for size in os.environ.get('RENDITION_SIZES', '256,1024,2048').split(',') if size.strip()]
+
+# ORIGINAL keeps the uploaded format, WEBP or AVIF re-encode everything.
+# AVIF falls back to WEBP when this Pillow build has no AVIF encoder
+OUTPUT_FORMAT = os.environ.get('OUTPUT_FORMAT', 'ORIGINAL').upper()
+
+# encoder settings per output format, anything not listed uses Pillow's defaults
+ENCODER_OPTIONS = {
+    'JPEG': {'quality': int(os.environ.get('JPEG_QUALITY', 85)), 'optimize': True, 'progressive': True},
+    'WEBP': {'quality': int(os.environ.get('WEBP_QUALITY', 80)), 'method': 4},
+    'AVIF': {'quality': int(os.environ.get('AVIF_QUALITY', 60)), 'speed': 6},
+    'PNG': {'optimize': True}
+}
+# formats Pillow reads that are written back as something else
+SAVE_FORMATS = {'MPO': 'JPEG'}
+# longest edge WebP can hold, bigger images go to AVIF or keep their format
+WEBP_MAX_DIMENSION = 16383
+
+# how long a claim on an image holds, after that a redelivery may take over.
+# Matches the function timeout
+PROCESSING_CLAIM_SECONDS = int(os.environ.get('PROCESSING_CLAIM_SECONDS', 200))
+
+# the pipeline runs in these stages, the last one completed is checkpointed
+# on the row and in the retry message so a retry resumes where it failed
+STAGES = ['fetch', 'render', 'publish', 'index', 'cleanup']
+# rendered output of a failed attempt is parked here in the staging bucket,
+# the bucket lifecycle expires it with everything else
+SCRATCH_PREFIX = 'scratch/'
+
+# email -> (expires_at, user details), lives as long as the container
+USER_CACHE_TTL_SECONDS = int(os.environ.get('USER_CACHE_TTL_SECONDS', 900))
+user_details_cache = {}
+user_cache_lock = threading.Lock()
+
+# boto3 resources are not thread safe, every worker thread gets its own.
+# The pools keep their threads between invocations, so this is set up once per thread
+thread_local = threading.local()
+
+
+def get_dynamodb():
+    if not hasattr(thread_local, 'dynamodb'):
+        thread_local.dynamodb = boto3.session.Session().resource('dynamodb')
+    return thread_local.dynamodb
+
+
+class MemoryBudget:
+    # admission control for the worker pool, an image only starts once its
+    # estimated memory fits next to the images already in flight. An image
+    # bigger than the whole budget still runs, on its own
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self.condition:
+            self.condition.wait_for(lambda: self.in_use == 0 or self.in_use + amount <= self.limit)
+            self.in_use += amount
+
+    def release(self, amount):
+        with self.condition:
+            self.in_use -= amount
+            self.condition.notify_all()
+
+
+memory_budget = MemoryBudget(PROCESSING_MEMORY_BUDGET)
+
+
+def wait_all(futures):
+    # every call gets to finish before the first error is raised
+    wait(futures)
+    for future in futures:
+        future.result()
+
+
+def estimate_memory(pixels):
+    # bigger JPEGs are decoded at a reduced scale, so at most the budget is decoded
+    decoded_pixels = min(pixels or MAX_IMAGE_PIXELS, MAX_IMAGE_PIXELS)
+    return decoded_pixels * BYTES_PER_PIXEL_ESTIMATE + SPOOL_MAX_SIZE
+
+class ImageTooLargeError(PermanentProcessingError):
+    reason = 'too_large'
+
+
+@lru_cache(maxsize=32)
+def get_font(font_size):
+    # one FreeTypeFont per size, loaded once per container
+    try:
+        font = ImageFont.truetype(FONT_PATH, font_size)
+        logger.info(f"bundled font loaded for size {font_size}")
+    except IOError:
+        font = ImageFont.load_default()  # Fallback if the bundled font is missing
+        logger.info("default is being used")
+    return font
+
+# Strong bold text color (more contrast)
+WATERMARK_TEXT_COLOR = (255, 255, 255, 230)  # White with higher opacity
+WATERMARK_STROKE_COLOR = (0, 0, 0, 255)
+WATERMARK_STROKE_WIDTH = 3
+WATERMARK_PADDING = 30  # Extra spacing around text
+
+WATERMARK_LINE_SPACING = 4  # between the name and the time line, Pillow's multiline default
+
+
+def render_text_tile(font_size, text):
+    # one line of text cropped to its stroked outline, so only that small region
+    # is allocated and composited per image. Returns the tile, where it sits
+    # against the text origin and the bounding box of the text itself
+    font = get_font(font_size)
+    measure = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+
+    text_bbox = measure.textbbox((0, 0), text, font=font)
+    stroke_bbox = measure.textbbox((0, 0), text, font=font, stroke_width=WATERMARK_STROKE_WIDTH)
+    tile = Image.new('RGBA', (stroke_bbox[2] - stroke_bbox[0], stroke_bbox[3] - stroke_bbox[1]), color=(0, 0, 0, 0))
+    ImageDraw.Draw(tile).text(
+        (-stroke_bbox[0], -stroke_bbox[1]),
+        text,
+        fill=WATERMARK_TEXT_COLOR,
+        font=font,
+        stroke_fill=WATERMARK_STROKE_COLOR,
+        stroke_width=WATERMARK_STROKE_WIDTH
+    )
+
+    return tile, (stroke_bbox[0], stroke_bbox[1]), text_bbox
+
+
+@lru_cache(maxsize=64)
+def get_name_tile(font_size, user_name):
+    # the font size is derived from the image width, so it doubles as the
+    # image size bucket. The name is the same on every image of a user, the
+    # time line under it changes every second and is rendered per image
+    return render_text_tile(font_size, user_name)
+
+
+@lru_cache(maxsize=32)
+def get_line_height(font_size):
+    # what Pillow leaves between the lines of multiline text
+    font = get_font(font_size)
+    return font.getbbox('A', stroke_width=WATERMARK_STROKE_WIDTH)[3] + WATERMARK_STROKE_WIDTH + WATERMARK_LINE_SPACING
+
+
+def composite_tile(base_image, tile, x, y):
+    # alpha composite the tile at (x, y), clipping whatever falls outside the frame
+    left, top = max(x, 0), max(y, 0)
+    right, bottom = min(x + tile.width, base_image.width), min(y + tile.height, base_image.height)
+    if right <= left or bottom <= top:
+        return
+    source = (left - x, top - y, right - x, bottom - y)
+    if base_image.mode == 'RGBA':
+        base_image.alpha_composite(tile, dest=(left, top), source=source)
+        return
+    # opaque image, only the region under the text goes through RGBA
+    region = base_image.crop((left, top, right, bottom)).convert('RGBA')
+    region.alpha_composite(tile, source=source)
+    base_image.paste(region.convert(base_image.mode), (left, top))
+
+
+def get_output_format(original_format, size):
+    # Pillow reports many phone JPEGs as MPO, only the first frame is kept anyway
+    original_format = SAVE_FORMATS.get(original_format, original_format)
+    if OUTPUT_FORMAT == 'AVIF' and features.check('avif'):
+        return 'AVIF'
+    if max(size) > WEBP_MAX_DIMENSION:
+        # WebP cannot hold it (panoramas), AVIF can
+        return 'AVIF' if OUTPUT_FORMAT == 'WEBP' and features.check('avif') else original_format
+    if OUTPUT_FORMAT in ('AVIF', 'WEBP') and features.check('webp'):
+        return 'WEBP'
+    return original_format
+
+
+def encode_image(image, image_format, **extra_options):
+    output = io.BytesIO()
+    image.save(output, format=image_format, **ENCODER_OPTIONS.get(image_format, {}), **extra_options)
+    return output.getvalue()
+
+
+def make_renditions(image, sizes, image_format, **extra_options):
+    # largest first, each one is scaled down from the previous so every step
+    # is cheaper than the last. reduce() does the integer part of the shrink
+    # with a box filter and resize() only finishes off the remainder.
+    # Images are never scaled up, sizes bigger than the original are skipped
+    renditions = {}
+    source = image
+    for size in sorted(set(sizes), reverse=True):
+        if max(image.size) <= size:
+            continue
+        factor = max(source.size) // size
+        if factor >= 2:
+            source = source.reduce(factor)
+        scale = size / max(source.size)
+        if scale < 1:
+            source = source.resize(
+                (max(1, round(source.width * scale)), max(1, round(source.height * scale))),
+                Image.LANCZOS
+            )
+
+        renditions[size] = encode_image(source, image_format, **extra_options)
+    return renditions
+
+
+def rendition_key(size, key):
+    return f"renditions/{size}/{key}"
+
+
+def sniff_image(bucket, key):
+    # ranged GET of the first bytes, returns the object's ContentType and
+    # Metadata like head_object would, plus the format and dimensions
+    length = SNIFF_BYTES
+    while True:
+        response = s3.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{length - 1}")
+        head = response['Body'].read()
+        try:
+            with Image.open(io.BytesIO(head)) as probe:
+                return response, probe.format, probe.size
+        except Image.DecompressionBombError as e:
+            raise ImageTooLargeError(str(e))
+        except Exception as e:
+            if len(head) < length or length >= MAX_SNIFF_BYTES:
+                # the decode later still has Pillow's own limit
+                logger.info(f"Could not read the image header: {str(e)}")
+                return response, None, None
+            length *= 4
+
+
+def object_size(response):
+    # the ranged GET reports the full size after the slash: "bytes 0-65535/1234567"
+    content_range = response.get('ContentRange')
+    if content_range and '/' in content_range:
+        return int(content_range.rsplit('/', 1)[1])
+    return response.get('ContentLength')
+
+
+def check_source_size(size, max_bytes):
+    if size is not None and size > max_bytes:
+        raise ImageTooLargeError(f"object of {size} bytes is over the download limit of {max_bytes}")
+
+
+def check_pixel_budget(image_format, size, max_pixels):
+    if not size or size[0] * size[1] <= max_pixels:
+        return
+    if image_format == 'JPEG' and size[0] * size[1] <= max_pixels * JPEG_DRAFT_MAX_SCALE ** 2:
+        return
+    raise ImageTooLargeError(f"{image_format} image of {size[0]}x{size[1]} pixels is over the budget of {max_pixels}")
 
-PHOTOAPPUSER = "user"
-attempt = 1
 
-def ensure_font_exists():
-    if not os.path.exists(FONT_PATH):
-        logger.info("Downloading Arial Bold font...")
-        response = requests.get(FONT_URL)
-        if response.status_code == 200:
-            with open(FONT_PATH, "wb") as font_file:
-                font_file.write(response.content)
-            logger.info("Font downloaded successfully!")
-        else:
-            logger.info("Failed to download font, using default.")
+def draft_to_budget(image, max_pixels):
+    # JPEG only, picks the smallest power of two scale that fits the budget and
+    # decodes at that scale instead of decoding everything and resizing
+    pixels = image.width * image.height
+    if pixels <= max_pixels:
+        return image
+    scale = 2 ** math.ceil(math.log2(math.sqrt(pixels / max_pixels)))
+    image.draft('RGB', (math.ceil(image.width / scale), math.ceil(image.height / scale)))
+    logger.info(f"Decoding at 1/{scale} scale, {image.width}x{image.height}")
+    if image.width * image.height > max_pixels:
+        raise ImageTooLargeError(f"image of {image.width}x{image.height} pixels is over the budget of {max_pixels}")
+    return image
 
-def add_watermark(image_bytes, user_name, include_strokes=False):
-    # global PHOTOAPPUSER
-    # PHOTOAPPUSER = user_name
 
-    # print(PHOTOAPPUSER)
+# identify the photographer or their camera, the processed copy is what
+# guest share links hand out
+PRIVATE_EXIF_TAGS = (ExifTags.Base.BodySerialNumber, ExifTags.Base.LensSerialNumber, ExifTags.Base.CameraOwnerName)
 
+
+def strip_private_exif(exif):
+    # the GPS IFD holds where the photo was taken
+    exif.get_ifd(ExifTags.IFD.GPSInfo).clear()
+    exif.pop(ExifTags.IFD.GPSInfo, None)
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    for tag in PRIVATE_EXIF_TAGS:
+        exif_ifd.pop(tag, None)
+    return exif
+
+
+def add_watermark(image_file, user_name, include_strokes=False, rendition_sizes=(), max_pixels=MAX_IMAGE_PIXELS):
     logger.info("Adding watermark to image...")
     # Open the image
-    input_image = Image.open(io.BytesIO(image_bytes))
+    input_image = Image.open(image_file)
     original_format = input_image.format or "PNG"  # Default to PNG if format is missing
-    input_image = input_image.convert('RGBA')
-    width, height = input_image.size
+    input_image = draft_to_budget(input_image, max_pixels)
 
-    overlay = Image.new('RGBA', input_image.size, color=(0, 0, 0, 0))  # Fully transparent overlay
-    draw = ImageDraw.Draw(overlay)
+    # kept for the saved copy without the location and serial numbers, the
+    # pixels are turned upright so the watermark reads the right way and the
+    # tag is reset to match
+    exif = input_image.getexif()
+    # a CMYK or grayscale profile would not match the RGB pixels that are saved
+    icc_profile = input_image.info.get('icc_profile') if input_image.mode in ('RGB', 'RGBA') else None
+    if exif.get(ExifTags.Base.Orientation, 1) != 1:
+        input_image = ImageOps.exif_transpose(input_image)
+        exif = input_image.getexif()
 
-    # Deep bold watermark color pattern (more opacity)
-    watermark_color_pattern = (255, 255, 255, 255)  # White with stronger opacity
+    # opaque images keep a single RGB frame, only images with transparency
+    # or the full frame strokes pay for an RGBA copy
+    if include_strokes or input_image.has_transparency_data:
+        input_image = input_image.convert('RGBA')
+    elif input_image.mode != 'RGB':
+        input_image = input_image.convert('RGB')
+    width, height = input_image.size
 
-    # Draw diagonal watermark lines
+    # Draw diagonal watermark lines, these cover the whole frame so they still need a full overlay
     if include_strokes:
+        overlay = Image.new('RGBA', input_image.size, color=(0, 0, 0, 0))  # Fully transparent overlay
+        draw = ImageDraw.Draw(overlay)
+        watermark_color_pattern = (255, 255, 255, 255)  # White with stronger opacity
         for i in range(0, width + height, 50):
             draw.line([(0, height - i), (i, height)], fill=watermark_color_pattern, width=8)  # Thicker lines
+        input_image.alpha_composite(overlay)
     
     # Load font with bold effect
     font_size = max(90, width // 15)
 
-    ensure_font_exists() # comment out when testing
-
-    try:
-        font = ImageFont.truetype(FONT_PATH, font_size)  # 'arialbd.ttf' is the bold version
-        logger.info("font arialbd is being used")
-        print("yes")
-    
-    except IOError:
-        font = ImageFont.load_default()  # Fallback if Arial Bold is not found
-        logger.info("default is being used")
-        font_size = 120
-        print("no")
-
     # Add watermark text
-    watermark_text = f"{PHOTOAPPUSER}\n{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-    
-    # Calculate text size with spacing
-    padding = 30  # Extra spacing around text
-    try:
-        bbox = draw.textbbox((0, 0), watermark_text, font=font)
-        text_width = bbox[2] - bbox[0] + padding
-        text_height = bbox[3] - bbox[1] + padding
-    except AttributeError:  # Fallback for older Pillow versions
-        text_width = text_height = 300
+    line_height = get_line_height(font_size)
+    lines = [
+        (get_name_tile(font_size, user_name), 0),
+        (render_text_tile(font_size, datetime.now().strftime('%Y-%m-%d %H:%M:%S')), line_height)
+    ]
+    left = min(text_bbox[0] for (_, _, text_bbox), _ in lines)
+    top = min(text_bbox[1] + line_y for (_, _, text_bbox), line_y in lines)
+    text_width = max(text_bbox[2] for (_, _, text_bbox), _ in lines) - left + WATERMARK_PADDING
+    text_height = max(text_bbox[3] + line_y for (_, _, text_bbox), line_y in lines) - top + WATERMARK_PADDING
 
     # Position watermark text in the center with extra spacing
     x = (width - text_width) // 2
     y = (height - text_height) // 2
 
-    # Strong bold text color (more contrast)
-    watermark_color_text = (255, 255, 255, 230)  # White with higher opacity
+    # Merge only the text regions with the original image
+    for (tile, (offset_x, offset_y), _), line_y in lines:
+        composite_tile(input_image, tile, x + offset_x, y + line_y + offset_y)
 
-    # Draw text multiple times to make it bolder (shadow effect)
-    offsets = [-3, 0, 3]
-    # for offset in offsets:
-    #     draw.text((x + offset, y), watermark_text, fill=watermark_color_text, font=font)
-    stroke_width = 3 
-    stroke_color = (0, 0, 0, 255)
-    draw.text((x, y), watermark_text, fill=watermark_color_text, font=font, stroke_fill=stroke_color, stroke_width=stroke_width)
+    watermark_image = input_image.convert("RGB") if input_image.mode != 'RGB' else input_image
 
-    # Merge the overlay with the original image
-    watermark_image = Image.alpha_composite(input_image, overlay)
+    # Save the watermarked image
+    output_format = get_output_format(original_format, watermark_image.size)
+    color_options = {'icc_profile': icc_profile} if icc_profile else {}
+    output = encode_image(watermark_image, output_format, exif=strip_private_exif(exif).tobytes(), **color_options)
 
-    watermark_image = watermark_image.convert("RGB")
+    # the renditions come from the same decoded, watermarked frame
+    renditions = make_renditions(watermark_image, rendition_sizes, output_format, **color_options)
 
-    # Save the watermarked image
-    output = io.BytesIO()
-    watermark_image.save(output, format=original_format)
-    # seek
-    output.seek(0)
+    return output, renditions, output_format
+
+
+def get_content_hash(image_file):
+    # sha256 of the uploaded bytes, read in chunks so a spooled file stays on disk
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: image_file.read(1024 * 1024), b''):
+        digest.update(chunk)
+    image_file.seek(0)
+    return digest.hexdigest()
+
+
+def get_existing_copy(user_id, content_hash):
+    # the row of an earlier upload of the same bytes, as long as its processed
+    # copy is still live. Anything else means the image is processed again
+    if not os.environ.get('IMAGE_HASH_TABLE'):
+        return None
+
+    hash_table = get_dynamodb().Table(os.environ['IMAGE_HASH_TABLE'])
+    entry = hash_table.get_item(Key={'user_id': user_id, 'content_hash': content_hash}).get('Item')
+    if not entry:
+        return None
+
+    original = get_dynamodb().Table(os.environ['USER_TABLE']).get_item(
+        Key={'user_id': user_id, 'image_id': entry['image_id']},
+        ConsistentRead=True
+    ).get('Item')
+    if not original or original.get('status') != 'water-marked' or original.get('deletion_mode') != 'none':
+        return None
+    return original
 
-    return output.getvalue()
+
+def add_duplicate(user_id, content_hash, original_id, image_id):
+    # the hash entry counts the duplicates sharing the original's objects, so
+    # the purge worker hands them over instead of deleting them. False when
+    # the original lost the entry since it was read, the image is then
+    # processed on its own
+    hash_table = get_dynamodb().Table(os.environ['IMAGE_HASH_TABLE'])
+    try:
+        hash_table.update_item(
+            Key={
+                'user_id': user_id,
+                'content_hash': content_hash
+            },
+            UpdateExpression='ADD duplicates :image_ids, ref_version :one',
+            ConditionExpression='image_id = :original_id',
+            ExpressionAttributeValues={
+                ':image_ids': {image_id},
+                ':original_id': original_id,
+                ':one': 1
+            }
+        )
+    except hash_table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def save_content_hash(user_id, content_hash, image_id):
+    if not os.environ.get('IMAGE_HASH_TABLE'):
+        return
+
+    hash_table = get_dynamodb().Table(os.environ['IMAGE_HASH_TABLE'])
+    try:
+        # an entry that still has duplicates is kept, they need it to get
+        # the shared objects handed over when their original is purged
+        hash_table.put_item(
+            Item={
+                'user_id': user_id,
+                'content_hash': content_hash,
+                'image_id': image_id,
+                'createdAt': datetime.now().isoformat()
+            },
+            ConditionExpression='attribute_not_exists(duplicates)'
+        )
+    except hash_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info("The content hash belongs to an image with duplicates, leaving it")
+    except Exception as e:
+        # only costs a future duplicate its shortcut
+        logger.error(f"Could not save the content hash: {str(e)}")
 
 
 def unquote(anyString):
@@ -137,9 +521,9 @@ def get_user_by_email(email, user_pool_id):
     return response
 
 
-def get_user_details(user_id):
+def get_user_details_from_cognito(user_id):
     # the user id coming in here is the email
-    logger.info("getting user details... ")
+    logger.info("getting user details from cognito... ")
     response = get_user_by_email(user_id, os.environ['USER_POOL_ID'])
     logger.info(f"the response from gube => {response}")
 
@@ -165,201 +549,590 @@ def get_user_details(user_id):
         }
     except Exception as e:
         logger.error(f"Error getting user details: {str(e)}")
-        return {'user_name': 'exceptionUsername', 'email': 'no-email-provided'}
-    
-def lambda_handler(event, context):
-    logger.info("processing images invoked...")
+        return None
 
-    global attempt
-    attempt = 1
 
-    logger.info(f"Event coming in  => {json.dumps(event)}")
+def get_user_details_from_table(user_id):
+    # optional second level cache in the user information table
+    if not os.environ.get('USER_INFO_TABLE'):
+        return None
 
     try:
+        table = get_dynamodb().Table(os.environ['USER_INFO_TABLE'])
+        response = table.get_item(
+            Key={'user_id': user_id},
+            ProjectionExpression='cached_user_name, cached_email, cached_until'
+        )
+        item = response.get('Item')
+        if item and 'cached_user_name' in item and item.get('cached_until', 0) > time.time():
+            logger.info("user details found in the user information table")
+            return {
+                'user_name': item['cached_user_name'],
+                'email': item['cached_email']
+            }
+    except Exception as e:
+        logger.error(f"Error reading cached user details: {str(e)}")
 
-        
+    return None
 
-        # Check if this is an SQS retry
-        if 'Records' in event and event['Records'][0].get('eventSource') == 'aws:sqs':
-            logger.info("This is an SQS retry...")
-            message = json.loads(event['Records'][0]['body'])
-            attempt = message.get('attempt', 1)
-            logger.info(f"for Retry: attemp is => {attempt}")
-            bucket = message.get('bucket')
-            key = message.get('key')
-            logger.info(f"key gotten => {key}")
-        else:
-            # Initial S3 trigger
-            logger.info("This is an initial S3 trigger...")
-            key = event['Records'][0]['s3']['object']['key']
-            bucket = event['Records'][0]['s3']['bucket']['name']
-            logger.info(f"bucket is : {bucket}")
-
-        key = unquote(key)
-        logger.info(f"key unquoted => {key}")
-        logger.info(f"Processing key: {key}, attempt: {attempt}")
-
-        # Extract user_id and get user details
-        user_id = key.split('/')[0] # this is the email
-    
-        user_details = get_user_details(user_id)
-        user_name = user_details['user_name']
-        email = user_details['email']
 
-        # write a check here for the username
+def save_user_details_to_table(user_id, user_details):
+    if not os.environ.get('USER_INFO_TABLE'):
+        return
 
-        global PHOTOAPPUSER
-        PHOTOAPPUSER = user_name
-        
-        # Get the image from the staging 
-        logger.info(f"Getting image from bucket: {bucket}")
-        response = s3.get_object(Bucket=bucket, Key=key)
-        logger.info(f"response is : {response}")
-        image_content = response['Body'].read()
-
-        # # Get user information from the key (assuming key format: userid/imageid_<fileName.ext>) // image id is the file name here
-        image_id = key.split('/')[1].split('.')[0]
-
-        # try to simulate a fail, if the image name is starts with black
-        if 'black' in image_id:
-            raise Exception("Simulated failure..")
-
-        # Add watermark
-        processed_image = add_watermark(image_content, user_name, False)  # Get actual user name from Cognito
-
-        # # Upload to primary bucket
-        primary_bucket = os.environ['PRIMARY_BUCKET']
-        logger.info("Uploading to primary bucket...")
-        s3.put_object(
-            Bucket=primary_bucket,
-            Key=key,
-            Body=processed_image,
-            ContentType=response['ContentType']
+    try:
+        table = get_dynamodb().Table(os.environ['USER_INFO_TABLE'])
+        table.update_item(
+            Key={'user_id': user_id},
+            UpdateExpression='SET cached_user_name = :name, cached_email = :email, cached_until = :until',
+            ConditionExpression='attribute_exists(user_id)', # only annotate users that are registered
+            ExpressionAttributeValues={
+                ':name': user_details['user_name'],
+                ':email': user_details['email'],
+                ':until': int(time.time()) + USER_CACHE_TTL_SECONDS
+            }
         )
+    except Exception as e:
+        logger.info(f"Could not cache user details in the table: {str(e)}")
 
-        # # Update DynamoDB
-        logger.info("Store metadata in DynamoDB...")
-        table = dynamodb.Table(os.environ['USER_TABLE'])
 
-        logger.info("Getting metadata..")
-        if 'Metadata' in response:
-            metadata = response['Metadata']
-            logger.info(f"Metadata: {metadata}")
-        else: 
-            metadata = {}
+def get_user_details(user_id):
+    # the user id coming in here is the email
+    logger.info("getting user details... ")
+
+    with user_cache_lock:
+        cached = user_details_cache.get(user_id)
+    if cached and cached[0] > time.time():
+        logger.info("user details found in the container cache")
+        return cached[1]
+
+    user_details = get_user_details_from_table(user_id)
 
+    if user_details is None:
         try:
-            the_region = os.environ['THE_REGION']
+            user_details = get_user_details_from_cognito(user_id)
         except Exception as e:
-            the_region = 'eu-west-1'
-            
+            # throttled or unavailable, an expired entry is better than a retry
+            if cached:
+                logger.error(f"Cognito lookup failed, using expired cache entry: {str(e)}")
+                return cached[1]
+            raise
 
-        table.put_item(
-            Item={
+        if user_details is None:
+            if cached:
+                return cached[1]
+            return {'user_name': 'exceptionUsername', 'email': 'no-email-provided'}
+
+        save_user_details_to_table(user_id, user_details)
+
+    with user_cache_lock:
+        user_details_cache[user_id] = (time.time() + USER_CACHE_TTL_SECONDS, user_details)
+    return user_details
+
+def claim_image(table, user_id, image_id):
+    # conditional write that makes this invocation the only one processing
+    # the image. A row that is already water-marked, or claimed by someone
+    # else whose claim has not expired, means this delivery is a duplicate.
+    # Returns the token, the number of times processing was started and the
+    # checkpoint a failed attempt left on the row
+    token = str(uuid.uuid4())
+    now = int(time.time())
+    try:
+        response = table.update_item(
+            Key={
                 'user_id': user_id,
-                'image_id': image_id,
+                'image_id': image_id
+            },
+            UpdateExpression='SET #status = :processing, processing_token = :token, claim_expires_at = :expires ADD version :one, attempts :one',
+            ConditionExpression='attribute_not_exists(#status) OR (#status = :processing AND (attribute_not_exists(claim_expires_at) OR claim_expires_at < :now))',
+            ExpressionAttributeNames={
+                '#status': 'status'
+            },
+            ExpressionAttributeValues={
+                ':processing': 'processing',
+                ':token': token,
+                ':expires': now + PROCESSING_CLAIM_SECONDS,
+                ':now': now,
+                ':one': 1
+            },
+            ReturnValues='ALL_NEW'
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return None, None, None
+    item = response['Attributes']
+    # numbers come back as Decimal, the checkpoint also goes into a json message
+    checkpoint = json.loads(json.dumps(item.get('checkpoint', {}), default=int))
+    return token, int(item['attempts']), checkpoint
+
+
+def release_claim(table, user_id, image_id, token, checkpoint):
+    # lets the retry claim the image straight away instead of waiting for the
+    # claim to expire, and records how far this attempt got
+    try:
+        table.update_item(
+            Key={
+                'user_id': user_id,
+                'image_id': image_id
+            },
+            UpdateExpression='SET checkpoint = :checkpoint REMOVE processing_token, claim_expires_at',
+            ConditionExpression='processing_token = :token',
+            ExpressionAttributeValues={
+                ':token': token,
+                ':checkpoint': checkpoint
+            }
+        )
+    except Exception as e:
+        logger.error(f"Could not release the claim on {image_id}: {str(e)}")
+
+
+def publish_image(table, user_id, image_id, token, fields):
+    # processing -> water-marked, only while this invocation still holds the
+    # claim. Fields written at upload time (originalName, blog_space_id...) are kept.
+    # Returns False when the claim expired and another delivery took over
+    try:
+        table.update_item(
+            Key={
+                'user_id': user_id,
+                'image_id': image_id
+            },
+            UpdateExpression='SET ' + ', '.join(f'#{name} = :{name}' for name in fields) + ' REMOVE processing_token, claim_expires_at, checkpoint',
+            ConditionExpression='processing_token = :token',
+            ExpressionAttributeNames={f'#{name}': name for name in fields},
+            ExpressionAttributeValues={
+                ':token': token,
+                **{f':{name}': value for name, value in fields.items()}
+            }
+        )
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        return False
+    return True
+
+
+def stage_done(checkpoint, stage):
+    return checkpoint.get('stage') in STAGES and STAGES.index(checkpoint['stage']) >= STAGES.index(stage)
+
+
+def scratch_key(key):
+    return f"{SCRATCH_PREFIX}{key}"
+
+
+def download_image(bucket, key):
+    # large multipart uploads are streamed to a spooled file instead of being read into memory
+    image_file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+    s3.download_fileobj(bucket, key, image_file, Config=transfer_config)
+    image_file.seek(0)
+    return image_file
+
+
+def park_rendered_output(bucket, key, processed_image, renditions, content_type):
+    # keeps the output of a render whose publish failed, so the retry copies
+    # it over instead of downloading and watermarking again
+    s3.put_object(Bucket=bucket, Key=scratch_key(key), Body=processed_image, ContentType=content_type)
+    for size, rendition in renditions.items():
+        s3.put_object(Bucket=bucket, Key=scratch_key(rendition_key(size, key)), Body=rendition, ContentType=content_type)
+
+
+def publish_parked_output(bucket, key, primary_bucket, sizes, content_type):
+    # server side copies, the bytes never come back through the function
+    wait_all([
+        io_pool.submit(
+            s3.copy_object,
+            Bucket=primary_bucket,
+            Key=target_key,
+            CopySource={'Bucket': bucket, 'Key': scratch_key(target_key)},
+            ContentType=content_type,
+            MetadataDirective='REPLACE'
+        )
+        for target_key in [key] + [rendition_key(size, key) for size in sizes]
+    ])
+
+
+def cleanup_staging(bucket, key, sizes):
+    # the image is published by now, whatever is left here expires with the
+    # bucket lifecycle, so a failure is logged and not retried
+    keys = [key, scratch_key(key)] + [scratch_key(rendition_key(size, key)) for size in sizes]
+    try:
+        s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': k} for k in keys],
+                'Quiet': True
+            }
+        )
+    except Exception as e:
+        logger.error(f"Could not clean up the staging bucket: {str(e)}")
+
+
+def parse_record(record):
+    # works out the bucket, key, attempt and checkpoint for one record in the batch
+    checkpoint = {}
+    if record.get('eventSource') == 'aws:sqs':
+        logger.info("This is an SQS retry...")
+        message = json.loads(record['body'])
+        attempt = message.get('attempt', 1)
+        checkpoint = message.get('checkpoint') or {}
+        logger.info(f"for Retry: attemp is => {attempt}")
+        bucket = message.get('bucket')
+        key = message.get('key')
+        logger.info(f"key gotten => {key}")
+    else:
+        # Initial S3 trigger
+        logger.info("This is an initial S3 trigger...")
+        attempt = 1
+        key = record['s3']['object']['key']
+        bucket = record['s3']['bucket']['name']
+        logger.info(f"bucket is : {bucket}")
+
+    return bucket, unquote(key), attempt, checkpoint
+
+
+def process_image(bucket, key, attempt, checkpoint=None):
+    logger.info(f"Processing key: {key}, attempt: {attempt}")
+    user_name = 'user'
+    email = 'no-email-provided'
+
+    # Extract user_id and image_id (key format: userid/imageid.ext)
+    user_id = key.split('/')[0] # this is the email
+    image_id = key.split('/')[1].split('.')[0]
+    table = get_dynamodb().Table(os.environ['USER_TABLE'])
+    checkpoint = dict(checkpoint or {})
+    primary_bucket = os.environ['PRIMARY_BUCKET']
+    token = None
+    image_file = None
+    rendered = None
+    reserved_memory = 0
+    user_lookup = None
+
+    try:
+        # S3 notifications and SQS are at-least-once, a duplicate delivery
+        # stops here before any download or image work. A claim that fails
+        # (throttling, network) is retried like any other error below
+        token, attempts, saved_checkpoint = claim_image(table, user_id, image_id)
+        if token is None:
+            logger.info(f"{image_id} is already processed or being processed, skipping this delivery")
+            return
+
+        checkpoint = dict(checkpoint or saved_checkpoint or {})
+        logger.info(f"Resuming after stage: {checkpoint.get('stage', 'none')}")
+
+        if not stage_done(checkpoint, 'fetch'):
+            # the cognito lookup runs while the image is sniffed and downloaded
+            user_lookup = io_pool.submit(get_user_details, user_id)
+
+            # Check the image before fetching it, oversized images are rejected
+            # here instead of running the function out of memory
+            logger.info(f"Getting image from bucket: {bucket}")
+            response, image_format, image_size = sniff_image(bucket, key)
+            logger.info(f"format: {image_format}, size: {image_size}")
+            check_source_size(object_size(response), MAX_SOURCE_BYTES)
+            check_pixel_budget(image_format, image_size, MAX_IMAGE_PIXELS)
+            pixels = image_size[0] * image_size[1] if image_size else None
+
+            # waits for room next to the other images of the batch
+            reserved_memory = estimate_memory(pixels)
+            memory_budget.acquire(reserved_memory)
+
+            image_file = download_image(bucket, key)
+            content_hash = get_content_hash(image_file)
+
+            user_details = user_lookup.result()
+            user_name = user_details['user_name']
+            email = user_details['email']
+
+            # write a check here for the username
+
+            # try to simulate a fail, if the image name is starts with black
+            if 'black' in image_id:
+                raise Exception("Simulated failure..")
+
+            # the same bytes were uploaded before, point this image at the
+            # processed copy that already exists instead of watermarking again.
+            # Deleting it never removes the shared object, and the objects
+            # outlive the original for as long as a duplicate uses them
+            existing = get_existing_copy(user_id, content_hash)
+            if existing and not add_duplicate(user_id, content_hash, existing['image_id'], image_id):
+                existing = None
+            if existing:
+                logger.info(f"Same content as {existing['image_id']}, reusing its processed copy")
+                image_file.close()
+                published = publish_image(table, user_id, image_id, token, {
+                    'status': 'water-marked',
+                    'url': existing['url'],
+                    'createdAt': datetime.now().isoformat(),
+                    'uploadTime': datetime.now().isoformat(),
+                    'contentType': existing['contentType'],
+                    'size': existing['size'],
+                    'attempts': attempts,
+                    's3Key': existing['s3Key'],
+                    'likes': 0,
+                    'deletion_mode': 'none',
+                    'user_deletion_mode': f"{user_id}#none",
+                    'renditions': existing.get('renditions', {}),
+                    'duplicate_of': existing['image_id'],
+                    'content_hash': content_hash,
+                    'metadata': {
+                        **response.get('Metadata', {})
+                    }
+                })
+                if published:
+                    cleanup_staging(bucket, key, [])
+                return
+
+            checkpoint.update({
+                'stage': 'fetch',
+                'user_name': user_name,
+                'email': email,
+                'source_content_type': response['ContentType'],
+                'pixels': pixels,
+                'metadata': response.get('Metadata', {}),
+                'content_hash': content_hash
+            })
+
+        user_name = checkpoint['user_name']
+        email = checkpoint['email']
+
+        if not stage_done(checkpoint, 'render'):
+            if image_file is None:
+                reserved_memory = estimate_memory(checkpoint.get('pixels'))
+                memory_budget.acquire(reserved_memory)
+                image_file = download_image(bucket, key)
+
+            # Add watermark
+            with image_file:
+                processed_image, renditions, output_format = add_watermark(image_file, user_name, False, RENDITION_SIZES, MAX_IMAGE_PIXELS)  # Get actual user name from Cognito
+            rendered = (processed_image, renditions)
+
+            # the decoded frames are gone, only the encoded output is still held
+            held_memory = len(processed_image) + sum(len(rendition) for rendition in renditions.values())
+            if held_memory < reserved_memory:
+                memory_budget.release(reserved_memory - held_memory)
+                reserved_memory = held_memory
+
+            # the stored copy may be in another format than the upload, the key stays the same
+            checkpoint.update({
+                'stage': 'render',
+                'content_type': Image.MIME.get(output_format, checkpoint['source_content_type']),
+                'size': len(processed_image),
+                'renditions': sorted(renditions)
+            })
+
+        content_type = checkpoint['content_type']
+        hash_saved = None
+
+        if not stage_done(checkpoint, 'publish'):
+            logger.info("Uploading to primary bucket...")
+            if rendered:
+                # # Upload to primary bucket, upload_fileobj switches to parallel parts for big images
+                # the renditions go up next to the full size image
+                processed_image, renditions = rendered
+                uploads = [io_pool.submit(
+                    s3.upload_fileobj,
+                    io.BytesIO(processed_image),
+                    primary_bucket,
+                    key,
+                    ExtraArgs={'ContentType': content_type},
+                    Config=transfer_config
+                )]
+
+                for size, rendition in renditions.items():
+                    uploads.append(io_pool.submit(
+                        s3.put_object,
+                        Bucket=primary_bucket,
+                        Key=rendition_key(size, key),
+                        Body=rendition,
+                        ContentType=content_type
+                    ))
+                wait_all(uploads)
+            else:
+                publish_parked_output(bucket, key, primary_bucket, checkpoint['renditions'], content_type)
+            logger.info(f"Uploaded renditions: {checkpoint['renditions']}")
+            checkpoint['stage'] = 'publish'
+
+        if not stage_done(checkpoint, 'index'):
+            # # Update DynamoDB
+            logger.info("Store metadata in DynamoDB...")
+
+            try:
+                the_region = os.environ['THE_REGION']
+            except Exception as e:
+                the_region = 'eu-west-1'
+
+            published = publish_image(table, user_id, image_id, token, {
                 'status': 'water-marked',
                 'url': f"https://{primary_bucket}.s3.{the_region}.amazonaws.com/{key}",
                 'createdAt': datetime.now().isoformat(),
                 'uploadTime': datetime.now().isoformat(),
-                'contentType': response['ContentType'],
-                'size': len(processed_image),
-                'attempts': attempt,
+                'contentType': content_type,
+                'size': checkpoint['size'],
+                'attempts': attempts,
                 's3Key': key,
                 'likes': 0,
                 'deletion_mode': 'none', # can be none, soft, hard
+                'user_deletion_mode': f"{user_id}#none", # key of the DeletionModeIndex used by listings
+                'renditions': {str(size): rendition_key(size, key) for size in checkpoint['renditions']},
+                'content_hash': checkpoint['content_hash'],
                 'metadata': {
-                    **metadata
+                    **checkpoint['metadata']
                 }
-            }
-        )
+            })
 
-        # deletion mode can be none, soft, hard
+            if not published:
+                # the delivery that took over owns the row and the staging object now
+                logger.info(f"Claim on {image_id} was lost, leaving it to the other delivery")
+                return
+
+            # the hash entry and the staging cleanup don't depend on each other
+            hash_saved = io_pool.submit(save_content_hash, user_id, checkpoint['content_hash'], image_id)
+            checkpoint['stage'] = 'index'
 
         # Delete from staging bucket
         logger.info("Deleting object from staging")
-        s3.delete_object(Bucket=bucket, Key=key)
+        cleanup_staging(bucket, key, checkpoint['renditions'])
+        if hash_saved:
+            hash_saved.result()
         
         logger.info("Image processed and uploaded successfully")
 
-        return {
-            'statusCode': 200,
-            'headers': myHeaders,
-            'body': json.dumps({'message': 'Image processed and uploaded successfully'})
-        }
-
     except Exception as e:
         logger.error(f"Error processing image: {str(e)}")
+        if user_lookup is not None and 'email' not in checkpoint:
+            # the image failed before the lookup was used, the user is still told
+            try:
+                user_details = user_lookup.result()
+                user_name = user_details['user_name']
+                email = user_details['email']
+            except Exception as lookup_error:
+                logger.error(f"Could not get the user details: {str(lookup_error)}")
+        if image_file is not None:
+            image_file.close()
+        if rendered and checkpoint.get('stage') == 'render':
+            try:
+                park_rendered_output(bucket, key, rendered[0], rendered[1], checkpoint['content_type'])
+            except Exception as park_error:
+                logger.error(f"Could not park the rendered output: {str(park_error)}")
+                checkpoint['stage'] = 'fetch'
+        if token is not None:
+            release_claim(table, user_id, image_id, token, checkpoint)
+        handle_processing_failure(bucket, key, attempt, e, email, checkpoint, user_name)
 
-        if attempt < 3:
-            # send to sqs for retry
-            logger.info("sending to sqs for retry")
-            sqs.send_message(
-                QueueUrl=os.environ['SQS_QUEUE_URL'],
-                MessageBody=json.dumps({
-                    'bucket': bucket,
-                    'key': key,
-                    'attempt': attempt + 1,
-                    'error': str(e)
-                }),
-                DelaySeconds=60  # 1 minute delay #DelaySeconds=300  # 5 minute delay
-            )
-        
-            # Send failure notification
-            logger.info("sending failure notification")
-            logger.info("Attempt is = " + event.get('attempt', "No atempt in the event"))
-            sns.publish(
-                TopicArn=os.environ['SNS_RETRY_TOPIC_ARN'],
-                Message=f"""
-                Hello {PHOTOAPPUSER},
-                
-                We encountered an issue processing your image: {key}
-                Attempt: {attempt} of 3
-                
-                Don't worry - we'll automatically retry the processing in 5 minutes.
-                You'll receive another notification about the status.
-                
-                Best regards,
-                Your App Team - Photo Blog - Frank
-                """,
-                Subject='Image Processing Failed - Automatic Retry Scheduled',
-                MessageAttributes={
-                    'email': {
-                        'DataType': 'String',
-                        'StringValue': email
-                    }
-                }
-            )
+    finally:
+        if reserved_memory:
+            memory_budget.release(reserved_memory)
 
-        else:
-            # Final failure notification
-            sns.publish(
-                TopicArn=os.environ['SNS_RETRY_TOPIC_ARN'],
-                Message=f"""
-                Hello {PHOTOAPPUSER},
-                
-                We're sorry, but we were unable to process your image: {key}
-                after {attempt} attempts.
-                
-                Please try uploading the image again or contact support if the issue persists.
-                
-                Best regards,
-                Your App Team - Photo Blog - Frank
-                """,
-                Subject='Image Processing Failed - Maximum Retries Reached',
-                MessageAttributes={
-                    'email': {
-                        'DataType': 'String',
-                        'StringValue': email
-                    }
-                }
-            )
+
+def handle_processing_failure(bucket, key, attempt, error, email, checkpoint=None, user_name='user'):
+    # transient errors are retried with backoff, permanent ones (and the
+    # last attempt) go to the DLQ with a reason code and the user is told once
+    kind, reason = classify_error(error)
+    logger.info(f"Failure is {kind}, reason: {reason}")
+
+    message = {
+        'bucket': bucket,
+        'key': key,
+        'error': str(error),
+        'reason': reason,
+        'checkpoint': checkpoint or {}
+    }
+
+    if kind == TRANSIENT and attempt < MAX_ATTEMPTS:
+        # send to sqs for retry
+        delay = backoff_delay(attempt)
+        logger.info(f"sending to sqs for retry in {delay}s")
+        sqs.send_message(
+            QueueUrl=os.environ['SQS_QUEUE_URL'],
+            MessageBody=json.dumps({
+                **message,
+                'attempt': attempt + 1
+            }),
+            DelaySeconds=delay
+        )
+        return
+
+    logger.info("sending to the dead letter queue")
+    # the notification goes out while the DLQ message is sent
+    dead_lettered = io_pool.submit(
+        sqs.send_message,
+        QueueUrl=os.environ['DLQ_URL'],
+        MessageBody=json.dumps({
+            **message,
+            'attempt': attempt,
+            'kind': kind
+        })
+    )
+
+    # Final failure notification
+    sns.publish(
+        TopicArn=os.environ['SNS_RETRY_TOPIC_ARN'],
+        Message=f"""
+        Hello {user_name},
         
-        return {
-            'statusCode': 500,
-            'headers': myHeaders,
-            'body': json.dumps({'Error processing image': str(e)})
+        We're sorry, but we were unable to process your image: {key}
+        after {attempt} attempts.
+        
+        Please try uploading the image again or contact support if the issue persists.
+        
+        Best regards,
+        Your App Team - Photo Blog - Frank
+        """,
+        Subject='Image Processing Failed - Maximum Retries Reached',
+        MessageAttributes={
+            'email': {
+                'DataType': 'String',
+                'StringValue': email
+            }
         }
+    )
+    dead_lettered.result()
+
+
+class DeadlineReachedError(Exception):
+    pass
+
+
+def process_record(record, context=None):
+    # records wait for a free worker, one that would start too close to the
+    # timeout goes back to the queue untouched instead of being cut off
+    if context and context.get_remaining_time_in_millis() < MIN_START_MILLIS:
+        raise DeadlineReachedError(f"{context.get_remaining_time_in_millis()}ms left, not starting")
+    bucket, key, attempt, checkpoint = parse_record(record)
+    if key.startswith(SCRATCH_PREFIX):
+        # parked output of a failed attempt, not an upload
+        return
+    process_image(bucket, key, attempt, checkpoint)
+
+
+def lambda_handler(event, context):
+    logger.info("processing images invoked...")
+    logger.info(f"Event coming in  => {json.dumps(event)}")
+
+    # every record in the batch gets processed, a failed image is handed
+    # to the retry queue by process_image, so only records we could not
+    # even hand off are reported back (partial batch response)
+    batch_item_failures = []
+
+    records = event.get('Records', [])
+    logger.info(f"Number of records in batch => {len(records)}")
+
+    # records run side by side, the memory budget holds back big images
+    futures = [(record, record_pool.submit(process_record, record, context)) for record in records]
+
+    for record, future in futures:
+        try:
+            future.result()
+        except DeadlineReachedError as e:
+            logger.info(f"Returning record to the queue: {str(e)}")
+            if record.get('eventSource') == 'aws:sqs':
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+        except Exception as e:
+            logger.error(f"Could not process or hand off record: {str(e)}")
+            if record.get('eventSource') == 'aws:sqs':
+                batch_item_failures.append({'itemIdentifier': record['messageId']})
+
+    logger.info(f"batch item failures => {batch_item_failures}")
+
+    return {
+        'batchItemFailures': batch_item_failures
+    }
 
 
 
@@ -383,4 +1156,4 @@ def lambda_handler(event, context):
         #                 "StringValue": email
         #             }
         #         }
-        #     )
\ No newline at end of file
+        #     )
@@ -0,0 +1,73 @@
+import os
+import random
+import PIL
+from botocore.exceptions import BotoCoreError, ClientError
+from PIL import Image, UnidentifiedImageError
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+MAX_ATTEMPTS = 3
+BASE_DELAY_SECONDS = 30
+MAX_DELAY_SECONDS = 900  # SQS DelaySeconds limit
+
+THROTTLING_CODES = {
+    'Throttling', 'ThrottlingException', 'ThrottledException', 'TooManyRequestsException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'SlowDown',
+    'RequestThrottled', 'RequestThrottledException', 'LimitExceededException',
+    'TransactionInProgressException', 'RequestTimeout', 'RequestTimeoutException'
+}
+
+PILLOW_PATH = os.path.dirname(PIL.__file__) + os.sep
+
+
+class PermanentProcessingError(Exception):
+    # raised for images that fail the same way on every attempt
+    reason = 'permanent'
+
+
+def raised_by_pillow(error):
+    # the innermost frame of the traceback is Pillow decoding or encoding.
+    # An OSError carrying an errno (disk full, I/O error) came from the
+    # system, even when it surfaced through Pillow
+    if isinstance(error, OSError) and error.errno is not None:
+        return False
+    frame = error.__traceback__
+    if frame is None:
+        return False
+    while frame.tb_next:
+        frame = frame.tb_next
+    return frame.tb_frame.f_code.co_filename.startswith(PILLOW_PATH)
+
+
+def classify_error(error):
+    # returns (TRANSIENT or PERMANENT, reason code). Anything unknown is
+    # treated as transient, it is still bounded by MAX_ATTEMPTS
+    if isinstance(error, PermanentProcessingError):
+        return PERMANENT, error.reason
+
+    if isinstance(error, ClientError):
+        code = error.response.get('Error', {}).get('Code', 'Unknown')
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        if code in THROTTLING_CODES:
+            return TRANSIENT, f"throttled:{code}"
+        if status >= 500:
+            return TRANSIENT, f"server_error:{code}"
+        return PERMANENT, f"client_error:{code}"
+
+    if isinstance(error, (BotoCoreError, TimeoutError, ConnectionError)):
+        return TRANSIENT, f"network:{type(error).__name__}"
+
+    # Pillow reports images it cannot read or decode with these
+    if isinstance(error, (UnidentifiedImageError, Image.DecompressionBombError)):
+        return PERMANENT, 'unsupported_image'
+    if isinstance(error, (SyntaxError, ValueError, OSError)) and raised_by_pillow(error):
+        return PERMANENT, f"decode_error:{type(error).__name__}"
+
+    return TRANSIENT, f"unknown:{type(error).__name__}"
+
+
+def backoff_delay(attempt):
+    # exponential backoff with full jitter, attempt 1 waits up to 30s, then 60s,
+    # 120s... never more than SQS allows
+    return random.randint(0, min(MAX_DELAY_SECONDS, BASE_DELAY_SECONDS * 2 ** (attempt - 1)))
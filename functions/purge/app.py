@@ -0,0 +1,230 @@
+import json
+import boto3
+import os
+import logging
+from image_records import batch_delete_items, chunk_list, get_image_share_tokens
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+S3_DELETE_BATCH_SIZE = 1000  # S3 DeleteObjects limit
+
+
+def delete_s3_objects(bucket, keys):
+    # DeleteObjects in chunks of 1000, returns the keys S3 could not delete
+    failed_keys = set()
+    for chunk in chunk_list(keys, S3_DELETE_BATCH_SIZE):
+        response = s3.delete_objects(
+            Bucket=bucket,
+            Delete={
+                'Objects': [{'Key': key} for key in chunk],
+                'Quiet': True
+            }
+        )
+        for error in response.get('Errors', []):
+            logger.error(f"Error deleting {error['Key']}: {error.get('Code')} {error.get('Message')}")
+            failed_keys.add(error['Key'])
+    return failed_keys
+
+
+def hand_over_objects(table, hash_table, message):
+    # True when a duplicate of this image takes over its objects, they stay.
+    # Otherwise the hash entry goes before the objects, after that no new
+    # upload can become a duplicate of this image
+    hash_key = {
+        'user_id': message['user_id'],
+        'content_hash': message['content_hash']
+    }
+    entry = hash_table.get_item(Key=hash_key, ConsistentRead=True).get('Item')
+    if not entry:
+        return False
+    if entry['image_id'] != message['image_id']:
+        # a retry finds the objects already handed over to the new owner
+        owner = table.get_item(
+            Key={'user_id': message['user_id'], 'image_id': entry['image_id']},
+            ConsistentRead=True
+        ).get('Item')
+        return bool(owner) and owner.get('s3Key') in message['s3_keys']
+
+    duplicate_ids = sorted(entry.get('duplicates', []))
+    for candidate_id in duplicate_ids:
+        candidate = table.get_item(
+            Key={'user_id': message['user_id'], 'image_id': candidate_id},
+            ConsistentRead=True
+        ).get('Item')
+        # ids of uploads that never published, or were purged since, are skipped
+        if (not candidate or not candidate.get('duplicate_of')
+                or candidate.get('s3Key') not in message['s3_keys']
+                or candidate.get('deletion_mode') == 'pending_delete'):
+            continue
+
+        try:
+            dynamodb.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        'Update': {
+                            'TableName': hash_table.name,
+                            'Key': hash_key,
+                            'UpdateExpression': 'SET image_id = :new_owner DELETE duplicates :new_owners',
+                            'ConditionExpression': 'image_id = :image_id',
+                            'ExpressionAttributeValues': {
+                                ':new_owner': candidate_id,
+                                ':new_owners': {candidate_id},
+                                ':image_id': message['image_id']
+                            }
+                        }
+                    },
+                    {
+                        'Update': {
+                            'TableName': table.name,
+                            'Key': {'user_id': message['user_id'], 'image_id': candidate_id},
+                            'UpdateExpression': 'REMOVE duplicate_of',
+                            'ConditionExpression': 'attribute_exists(duplicate_of) AND deletion_mode <> :pending',
+                            'ExpressionAttributeValues': {
+                                ':pending': 'pending_delete'
+                            }
+                        }
+                    }
+                ]
+            )
+        except dynamodb.meta.client.exceptions.TransactionCanceledException:
+            logger.info(f"{candidate_id} changed while taking over, trying the next duplicate")
+            continue
+
+        logger.info(f"{candidate_id} takes over the objects of {message['image_id']}")
+        repoint_duplicates(table, message['user_id'], duplicate_ids, candidate_id)
+        return True
+
+    # a duplicate registered after the entry was read makes this fail, the
+    # message is then retried and sees it
+    hash_table.delete_item(
+        Key=hash_key,
+        ConditionExpression='image_id = :image_id AND (attribute_not_exists(ref_version) OR ref_version = :ref_version)',
+        ExpressionAttributeValues={
+            ':image_id': message['image_id'],
+            ':ref_version': entry.get('ref_version', 0)
+        }
+    )
+    return False
+
+
+def repoint_duplicates(table, user_id, duplicate_ids, new_owner):
+    # the remaining duplicates name the image that owns the objects now
+    for image_id in duplicate_ids:
+        if image_id == new_owner:
+            continue
+        try:
+            table.update_item(
+                Key={
+                    'user_id': user_id,
+                    'image_id': image_id
+                },
+                UpdateExpression='SET duplicate_of = :new_owner',
+                ConditionExpression='attribute_exists(duplicate_of)',
+                ExpressionAttributeValues={
+                    ':new_owner': new_owner
+                }
+            )
+        except Exception as e:
+            logger.info(f"Not re-pointing {image_id}: {str(e)}")
+
+
+def release_duplicate(hash_table, message):
+    # the duplicate no longer holds on to the shared objects
+    try:
+        hash_table.update_item(
+            Key={
+                'user_id': message['user_id'],
+                'content_hash': message['content_hash']
+            },
+            UpdateExpression='DELETE duplicates :image_ids',
+            ConditionExpression='attribute_exists(image_id)',
+            ExpressionAttributeValues={
+                ':image_ids': {message['image_id']}
+            }
+        )
+    except hash_table.meta.client.exceptions.ConditionalCheckFailedException:
+        pass
+    except Exception as e:
+        # a stale id is skipped when the objects are handed over, not worth a retry
+        logger.error(f"Error releasing duplicate {message['image_id']}: {str(e)}")
+
+
+def lambda_handler(event, context):
+    # removes hard deleted images: the objects, the shares and finally the
+    # row, so a message that fails part way is simply retried
+    records = event.get('Records', [])
+    logger.info(f"purging {len(records)} images...")
+
+    processed_bucket = os.environ['PROCESSED_BUCKET']
+    user_images_table_name = os.environ['USER_IMAGES_TABLE']
+    image_sharing_table_name = os.environ['IMAGE_SHARING_TABLE']
+    image_sharing_table = dynamodb.Table(image_sharing_table_name)
+
+    messages = {}
+    for record in records:
+        messages[record['messageId']] = json.loads(record['body'])
+
+    failed_ids = set()
+    hash_table = dynamodb.Table(os.environ['IMAGE_HASH_TABLE']) if os.environ.get('IMAGE_HASH_TABLE') else None
+
+    # objects still used by a duplicate upload are handed over to it instead of deleted
+    s3_keys = {}
+    for message_id, message in messages.items():
+        s3_keys[message_id] = message.get('s3_keys', [])
+        if hash_table is None or not message.get('content_hash') or message.get('duplicate') or not s3_keys[message_id]:
+            continue
+        try:
+            if hand_over_objects(dynamodb.Table(user_images_table_name), hash_table, message):
+                s3_keys[message_id] = []
+        except Exception as e:
+            logger.error(f"Error checking duplicates of {message['image_id']}: {str(e)}")
+            failed_ids.add(message_id)
+
+    # the objects of the whole batch go out in as few calls as possible
+    all_keys = sorted({key for message_id, keys in s3_keys.items() if message_id not in failed_ids for key in keys})
+    try:
+        failed_keys = delete_s3_objects(processed_bucket, all_keys)
+    except Exception as e:
+        logger.error(f"Error deleting objects: {str(e)}")
+        failed_keys = set(all_keys)
+
+    # the same image can be queued twice (a redelivered message, or a bulk
+    # delete racing the sweeper) and BatchWriteItem rejects duplicate keys
+    image_keys = set()
+    share_tokens = set()
+    for message_id, message in messages.items():
+        if message_id in failed_ids:
+            continue
+        if failed_keys.intersection(s3_keys[message_id]):
+            failed_ids.add(message_id)
+            continue
+        try:
+            share_tokens.update(get_image_share_tokens(image_sharing_table, message['user_id'], message['image_id']))
+        except Exception as e:
+            logger.error(f"Error reading shares of {message['image_id']}: {str(e)}")
+            failed_ids.add(message_id)
+            continue
+        image_keys.add((message['user_id'], message['image_id']))
+
+    try:
+        batch_delete_items(image_sharing_table_name, [{'share_token': share_token} for share_token in sorted(share_tokens)])
+        batch_delete_items(user_images_table_name, [{'user_id': user_id, 'image_id': image_id} for user_id, image_id in sorted(image_keys)])
+    except Exception as e:
+        # every remaining message is retried, the deletes are idempotent
+        logger.error(f"Error deleting rows: {str(e)}")
+        failed_ids.update(message_id for message_id in messages if message_id not in failed_ids)
+
+    if hash_table is not None:
+        for message_id, message in messages.items():
+            if message_id not in failed_ids and message.get('duplicate') and message.get('content_hash'):
+                release_duplicate(hash_table, message)
+
+    logger.info(f"purged {len(messages) - len(failed_ids)} images, {len(failed_ids)} to retry")
+
+    return {
+        'batchItemFailures': [{'itemIdentifier': message_id} for message_id in sorted(failed_ids)]
+    }
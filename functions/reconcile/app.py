@@ -0,0 +1,233 @@
+import json
+import boto3
+import os
+import time
+import logging
+from botocore.exceptions import ClientError
+
+s3 = boto3.client('s3')
+dynamodb = boto3.resource('dynamodb')
+ssm = boto3.client('ssm')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SOFT_DELETE_RETENTION_DAYS = int(os.environ.get('SOFT_DELETE_RETENTION_DAYS', 30))
+SCAN_PAGE_SIZE = 500  # items read per scan call, the time left is checked between pages
+MIN_REMAINING_MILLIS = 60 * 1000  # leave the rest to the next run
+PASS_INTERVAL_SECONDS = 24 * 60 * 60  # a pass may span several runs, a new one starts a day after the last
+
+
+def list_user_objects(bucket, user_id):
+    # one list call covers up to 1000 objects, instead of a head_object per image
+    keys = set()
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=f"{user_id}/"):
+        for obj in page.get('Contents', []):
+            keys.add(obj['Key'])
+    return keys
+
+
+def object_exists(bucket, key):
+    # the listing is taken once per user, an image published since then is
+    # only missing from the listing, so a miss is confirmed on the object itself
+    if not key:
+        return False
+    try:
+        s3.head_object(Bucket=bucket, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+
+def set_image_status(table, item, status):
+    logger.info(f"marking {item['user_id']}/{item['image_id']} as {status}")
+    table.update_item(
+        Key={
+            'user_id': item['user_id'],
+            'image_id': item['image_id']
+        },
+        UpdateExpression='SET #status = :status',
+        ConditionExpression='attribute_exists(user_id)',
+        ExpressionAttributeNames={
+            '#status': 'status'
+        },
+        ExpressionAttributeValues={
+            ':status': status
+        }
+    )
+
+
+def needs_backfill(item):
+    # rows processed before the DeletionModeIndex existed have no key in it,
+    # so the gallery listing would not see them, and rows soft deleted before
+    # the sweeper existed are not in the SoftDeletedIndex, so they were never purged
+    deletion_mode = item.get('deletion_mode', 'none')
+    if deletion_mode not in ('none', 'soft'):
+        return False
+    return 'user_deletion_mode' not in item or (deletion_mode == 'soft' and 'soft_deleted' not in item)
+
+
+def backfill_deletion_mode(table, item, now):
+    deletion_mode = item.get('deletion_mode')
+    logger.info(f"backfilling the index keys of {item['user_id']}/{item['image_id']}")
+    update_expression = 'SET user_deletion_mode = if_not_exists(user_deletion_mode, :key)'
+    values = {':key': f"{item['user_id']}#{deletion_mode or 'none'}"}
+    if deletion_mode:
+        condition = 'deletion_mode = :mode'
+        values[':mode'] = deletion_mode
+    else:
+        condition = 'attribute_not_exists(deletion_mode)'
+    if deletion_mode == 'soft':
+        # when it was deleted is not recorded, the retention period starts now
+        update_expression += ', soft_deleted = :soft_deleted, purge_at = if_not_exists(purge_at, :purge_at)'
+        values[':soft_deleted'] = 'true'
+        values[':purge_at'] = now + SOFT_DELETE_RETENTION_DAYS * 24 * 60 * 60
+    table.update_item(
+        Key={
+            'user_id': item['user_id'],
+            'image_id': item['image_id']
+        },
+        UpdateExpression=update_expression,
+        ConditionExpression=condition,
+        ExpressionAttributeValues=values
+    )
+
+
+def mark_backfill_complete():
+    # read by the view function, it lists from the DeletionModeIndex from then on
+    logger.info("every row has its index keys, marking the backfill complete")
+    ssm.put_parameter(
+        Name=os.environ['BACKFILL_STATUS_PARAMETER'],
+        Value='complete',
+        Type='String',
+        Overwrite=True
+    )
+
+
+def load_state():
+    # where the pass stopped, or when the next one starts
+    try:
+        return json.loads(ssm.get_parameter(Name=os.environ['RECONCILE_STATE_PARAMETER'])['Parameter']['Value'])
+    except ssm.exceptions.ParameterNotFound:
+        return {}
+
+
+def save_state(state):
+    ssm.put_parameter(
+        Name=os.environ['RECONCILE_STATE_PARAMETER'],
+        Value=json.dumps(state),
+        Type='String',
+        Overwrite=True
+    )
+
+
+def lambda_handler(event, context):
+    # checks that every processed image still has its object in the
+    # processed bucket, this used to run inline on every gallery listing.
+    # A pass over a large table spans several runs, each one carries on
+    # from where the previous one stopped
+    logger.info("reconciling processed images...")
+
+    table = dynamodb.Table(os.environ['USER_IMAGES_TABLE'])
+    processed_bucket = os.environ['PROCESSED_BUCKET']
+    now = int(time.time())
+
+    state = load_state()
+    if state.get('next_pass_at', 0) > now:
+        logger.info("the last pass finished less than a day ago, nothing to do")
+        return {
+            'statusCode': 200,
+            'body': json.dumps({'checked': 0})
+        }
+
+    scan_kwargs = {
+        'Limit': SCAN_PAGE_SIZE,
+        'FilterExpression': 'attribute_exists(#url)',
+        'ProjectionExpression': 'user_id, image_id, s3Key, #status, deletion_mode, user_deletion_mode, soft_deleted',
+        'ExpressionAttributeNames': {
+            '#url': 'url',
+            '#status': 'status'
+        }
+    }
+
+    # a scan returns a user's items together, so only the current user's
+    # listing is kept in memory
+    current_user = None
+    current_objects = set()
+    checked = 0
+    missing = 0
+    restored = 0
+    backfilled = 0
+    # failures of the whole pass, it is only complete if none of its runs had any
+    backfill_failed = state.get('backfill_failed', 0)
+    if state.get('start_key'):
+        logger.info(f"carrying on from {state['start_key']}")
+        scan_kwargs['ExclusiveStartKey'] = state['start_key']
+    pass_complete = False
+
+    while True:
+        response = table.scan(**scan_kwargs)
+
+        for item in response.get('Items', []):
+            user_id = item['user_id']
+            if user_id != current_user:
+                current_user = user_id
+                current_objects = list_user_objects(processed_bucket, user_id)
+
+            exists = item.get('s3Key') in current_objects
+            checked += 1
+
+            try:
+                if not exists and item.get('status') != 'image_not_found':
+                    if not object_exists(processed_bucket, item.get('s3Key')):
+                        set_image_status(table, item, 'image_not_found')
+                        missing += 1
+                elif exists and item.get('status') == 'image_not_found':
+                    set_image_status(table, item, 'water-marked')
+                    restored += 1
+            except Exception as e:
+                logger.error(f"Error updating {user_id}/{item['image_id']}: {str(e)}")
+
+            try:
+                if needs_backfill(item):
+                    backfill_deletion_mode(table, item, now)
+                    backfilled += 1
+            except table.meta.client.exceptions.ConditionalCheckFailedException:
+                # deleted or restored since the scan, that wrote the keys
+                logger.info(f"{user_id}/{item['image_id']} changed since the scan, not backfilling")
+            except Exception as e:
+                logger.error(f"Error backfilling {user_id}/{item['image_id']}: {str(e)}")
+                backfill_failed += 1
+
+        if 'LastEvaluatedKey' not in response:
+            pass_complete = True
+            break
+        scan_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+        if context and context.get_remaining_time_in_millis() < MIN_REMAINING_MILLIS:
+            logger.info("running out of time, the next run picks up the rest")
+            break
+
+    if pass_complete:
+        save_state({'next_pass_at': now + PASS_INTERVAL_SECONDS})
+        if backfill_failed == 0 and os.environ.get('BACKFILL_STATUS_PARAMETER'):
+            mark_backfill_complete()
+    else:
+        save_state({'start_key': scan_kwargs['ExclusiveStartKey'], 'backfill_failed': backfill_failed})
+
+    summary = {
+        'checked': checked,
+        'missing': missing,
+        'restored': restored,
+        'backfilled': backfilled,
+        'backfill_failed': backfill_failed,
+        'pass_complete': pass_complete
+    }
+    logger.info(f"reconcile summary => {summary}")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(summary)
+    }
@@ -5,6 +5,10 @@ import uuid
 import os
 from datetime import datetime
 import logging
+from image_records import (
+    DELETION_MODE_INDEX_FIELD, SOFT_DELETE_FIELDS,
+    batch_get_items, get_bulk_image_ids, get_image_share_tokens, get_shares_of_images, transact_set_deletion_mode
+)
 
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
@@ -21,6 +25,61 @@ myHeaders = {
 }
 
 
+def body_error(message):
+    return {
+        'statusCode': 400,
+        'headers': myHeaders,
+        'body': json.dumps({'error': message})
+    }
+
+
+def bulk_restore(event, user_id):
+    logger.info("bulk restore started...")
+
+    image_ids, body, error = get_bulk_image_ids(event)
+    if error:
+        return body_error(error)
+
+    user_images_table_name = os.environ['USER_IMAGES_TABLE']
+    image_sharing_table = dynamodb.Table(os.environ['IMAGE_SHARING_TABLE'])
+
+    items = batch_get_items(
+        user_images_table_name,
+        [{'user_id': user_id, 'image_id': image_id} for image_id in image_ids],
+        'user_id, image_id, deletion_mode'
+    )
+
+    # only soft deleted images can be restored, checked again on the write
+    # so an image the sweeper just handed to the purge worker stays deleted
+    restored_ids = [item['image_id'] for item in items if item.get('deletion_mode') == 'soft']
+    skipped_keys = transact_set_deletion_mode(
+        user_images_table_name,
+        [{'user_id': user_id, 'image_id': image_id} for image_id in restored_ids],
+        'none',
+        {DELETION_MODE_INDEX_FIELD: f"{user_id}#none"},
+        SOFT_DELETE_FIELDS,
+        from_mode='soft'
+    )
+    restored_ids = [image_id for image_id in restored_ids if image_id not in {key['image_id'] for key in skipped_keys}]
+    skipped_ids = sorted(set(image_ids) - set(restored_ids))
+
+    transact_set_deletion_mode(
+        os.environ['IMAGE_SHARING_TABLE'],
+        get_shares_of_images(image_sharing_table, user_id, restored_ids),
+        'none'
+    )
+
+    return {
+        'statusCode': 200,
+        'headers': myHeaders,
+        'body': json.dumps({
+            'message': f'Successfully restored {len(restored_ids)} images',
+            'restored': restored_ids,
+            'skipped': skipped_ids
+        })
+    }
+
+
 def lambda_handler(event, context):
     logger.info("deleting image started...")
     logger.info(f"Event: {event}")
@@ -31,6 +90,9 @@ def lambda_handler(event, context):
         user_email = event['requestContext']['authorizer']['claims']['email']
         user_id = user_email # changing this
 
+        if event.get('httpMethod') == 'POST':
+            return bulk_restore(event, user_id)
+
         image_id = None
 
          # Check if this is a shared image access
@@ -80,35 +142,38 @@ def lambda_handler(event, context):
         logger.info('changing the deletion type to none')
 
         user_images_table_response_item['deletion_mode'] = 'none'
+        user_images_table_response_item[DELETION_MODE_INDEX_FIELD] = f"{user_id}#none"
+        for name in SOFT_DELETE_FIELDS:
+            user_images_table_response_item.pop(name, None)
 
-        # update the user images table
+        # update the user images table, unless the sweeper marked the image
+        # pending_delete since it was read, the purge is already queued then
         logger.info("updating the table")
-        user_images_table.put_item(Item=user_images_table_response_item)
+        try:
+            user_images_table.put_item(
+                Item=user_images_table_response_item,
+                ConditionExpression='deletion_mode = :soft',
+                ExpressionAttributeValues={
+                    ':soft': 'soft'
+                },
+                ReturnValuesOnConditionCheckFailure='ALL_OLD'
+            )
+        except user_images_table.meta.client.exceptions.ConditionalCheckFailedException as e:
+            deletion_type = e.response.get('Item', {}).get('deletion_mode', {}).get('S')
+            return {
+                'statusCode': 400,
+                'headers': myHeaders,
+                'body': json.dumps({'error': f'Cannot restore image with deletion type of {deletion_type}'})
+            }
 
         # update the user images sharing table too
         image_sharing_table = dynamodb.Table(os.environ['IMAGE_SHARING_TABLE'])
-        image_sharing_table_response = image_sharing_table.scan()
-        logger.info(f"Response from DynamoDB: {image_sharing_table_response}")
-
-        try:
-            image_sharing_table_items = image_sharing_table_response.get('Items', [])
-        except Exception as e:
-            logger.error(f"Error getting the items {str(e)}")
-            image_sharing_table_items = []
-
-        if len(image_sharing_table_items) != 0:
-            for item in image_sharing_table_items:
-                if item['image_id'] == image_id:
-                    logger.info(f"Updating item in image_sharing_table: {item}")
-                    image_sharing_table.update_item(
-                        Key={
-                            'share_token': item['share_token']
-                        },
-                        UpdateExpression='SET deletion_mode = :val',
-                        ExpressionAttributeValues={
-                            ':val': 'none'
-                        }
-                    )
+        share_tokens = get_image_share_tokens(image_sharing_table, user_id, image_id)
+        transact_set_deletion_mode(
+            os.environ['IMAGE_SHARING_TABLE'],
+            [{'share_token': share_token} for share_token in share_tokens],
+            'none'
+        )
                         
         return {
             'statusCode': 200,
@@ -0,0 +1,112 @@
+import json
+import boto3
+import os
+import time
+import logging
+from boto3.dynamodb.conditions import Key
+from image_records import enqueue_purge
+
+dynamodb = boto3.resource('dynamodb')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+SOFT_DELETED_INDEX = 'SoftDeletedIndex'
+MIN_REMAINING_MILLIS = 30 * 1000  # leave the rest to the next run
+
+
+def mark_pending_delete(table, item, now):
+    # only if the image is still soft deleted and expired, a restore that
+    # happened after the index was read wins
+    try:
+        response = table.update_item(
+            Key={
+                'user_id': item['user_id'],
+                'image_id': item['image_id']
+            },
+            UpdateExpression='SET deletion_mode = :pending REMOVE soft_deleted, purge_at, user_deletion_mode',
+            ConditionExpression='deletion_mode = :soft AND purge_at <= :now',
+            ExpressionAttributeValues={
+                ':pending': 'pending_delete',
+                ':soft': 'soft',
+                ':now': now
+            },
+            ReturnValues='ALL_OLD'
+        )
+        return response['Attributes']
+    except table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"{item['user_id']}/{item['image_id']} is no longer expired, skipping")
+        return None
+
+
+def put_back(table, item):
+    # the message could not be queued, keep the image soft deleted so the next run retries it
+    table.update_item(
+        Key={
+            'user_id': item['user_id'],
+            'image_id': item['image_id']
+        },
+        UpdateExpression='SET deletion_mode = :soft, user_deletion_mode = :user_deletion_mode, '
+                         'soft_deleted = :soft_deleted, purge_at = :purge_at',
+        ExpressionAttributeValues={
+            ':soft': 'soft',
+            ':user_deletion_mode': f"{item['user_id']}#soft",
+            ':soft_deleted': item['soft_deleted'],
+            ':purge_at': item['purge_at']
+        }
+    )
+
+
+def lambda_handler(event, context):
+    # hands soft deleted images past their retention period to the purge worker,
+    # found through the sparse SoftDeletedIndex instead of scanning the table
+    logger.info("sweeping expired soft deleted images...")
+
+    table = dynamodb.Table(os.environ['USER_IMAGES_TABLE'])
+    now = int(time.time())
+
+    query_kwargs = {
+        'IndexName': SOFT_DELETED_INDEX,
+        'KeyConditionExpression': Key('soft_deleted').eq('true') & Key('purge_at').lte(now)
+    }
+
+    expired = 0
+    queued = 0
+
+    while True:
+        response = table.query(**query_kwargs)
+
+        pending_items = []
+        for item in response.get('Items', []):
+            expired += 1
+            try:
+                old_item = mark_pending_delete(table, item, now)
+            except Exception as e:
+                logger.error(f"Error marking {item['user_id']}/{item['image_id']}: {str(e)}")
+                continue
+            if old_item:
+                pending_items.append(old_item)
+
+        failed_ids = enqueue_purge(pending_items)
+        for old_item in pending_items:
+            if old_item['image_id'] in failed_ids:
+                put_back(table, old_item)
+        queued += len(pending_items) - len(failed_ids)
+
+        if 'LastEvaluatedKey' not in response:
+            break
+        if context and context.get_remaining_time_in_millis() < MIN_REMAINING_MILLIS:
+            logger.info("running out of time, the next run picks up the rest")
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    summary = {
+        'expired': expired,
+        'queued': queued
+    }
+    logger.info(f"sweep summary => {summary}")
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps(summary)
+    }
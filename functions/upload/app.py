@@ -20,6 +20,463 @@ myHeaders = {
     'Access-Control-Allow-Credentials': 'true'
 }
 
+PRESIGNED_UPLOAD_EXPIRATION = 900  # 15 minutes in seconds
+MAX_DIRECT_UPLOAD_SIZE = int(os.environ.get('MAX_DIRECT_UPLOAD_SIZE', 100 * 1024 * 1024))  # 100MB
+MULTIPART_PART_SIZE = int(os.environ.get('MULTIPART_PART_SIZE', 8 * 1024 * 1024))  # 8MB, S3 needs at least 5MB
+MAX_MULTIPART_PARTS = 10000  # S3 limit
+# the processor refuses to download anything bigger, keep the two in step
+MAX_MULTIPART_UPLOAD_SIZE = int(os.environ.get('MAX_MULTIPART_UPLOAD_SIZE', 400 * 1024 * 1024))  # 400MB
+MAX_PARTS_PER_REQUEST = 1000
+
+
+def get_blog_space_id(event, body=None):
+    # Check if the prams or the body constains the blog id
+    if event and "queryStringParameters" in event and event["queryStringParameters"]:
+        query_params = event["queryStringParameters"]
+        logger.info(f"Query parameters: {query_params}")
+
+        if "blog_space_id" in query_params:
+            return query_params["blog_space_id"]
+
+    if body and body.get("blog_space_id"):
+        return body["blog_space_id"]
+
+    return "no id"
+
+
+def new_upload_key(user_id, file_name):
+    # Generate unique image ID
+    image_id = str(uuid.uuid4())
+
+    # Generate S3 key (folder structure: user_id/filename)
+    custom_file_name  = image_id + "_" + file_name
+    s3_key = f"{user_id}/{custom_file_name}"
+
+    new_image_id = custom_file_name.split('.')[0]  # [su8792xuI_flower] [.jpg]
+
+    return s3_key, new_image_id
+
+
+def upload_metadata(user_id, new_image_id, file_name, blog_space_id):
+    return {
+        'user_id': user_id, # this is the user email now
+        'uploadTime': datetime.now().isoformat(),
+        'image_id': new_image_id,
+        'originalName': file_name,
+        'blog_space_id': blog_space_id
+    }
+
+
+def initiate_upload(event, user_id):
+    # the client sends only the file details here and then posts the
+    # image bytes straight to the staging bucket with the returned form
+    logger.info("initiating direct upload...")
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except json.JSONDecodeError:
+        return {
+            'statusCode': 400,
+            'headers': myHeaders,
+            'body': json.dumps({'error': 'Invalid JSON body'})
+        }
+
+    file_name = body.get('fileName') or body.get('filename')
+    content_type = body.get('contentType') or body.get('content-type')
+
+    if not file_name:
+        return {
+            'statusCode': 400,
+            'headers': myHeaders,
+            'body': json.dumps({'error': 'Filename not provided'})
+        }
+
+    if not content_type or not content_type.startswith('image/'):
+        return {
+            'statusCode': 400,
+            'headers': myHeaders,
+            'body': json.dumps({'error': 'File must be an image'})
+        }
+
+    blog_space_id = get_blog_space_id(event, body)
+    s3_key, new_image_id = new_upload_key(user_id, file_name)
+    metadata = upload_metadata(user_id, new_image_id, file_name, blog_space_id)
+
+    # the form fields and the policy conditions must match exactly, so the
+    # object lands with the same key layout and metadata as the old upload
+    fields = {'Content-Type': content_type}
+    conditions = [
+        {'Content-Type': content_type},
+        ['content-length-range', 1, MAX_DIRECT_UPLOAD_SIZE]
+    ]
+    for name, value in metadata.items():
+        fields[f'x-amz-meta-{name}'] = value
+        conditions.append({f'x-amz-meta-{name}': value})
+
+    presigned_post = s3.generate_presigned_post(
+        Bucket=os.environ['STAGE_BUCKET'],
+        Key=s3_key,
+        Fields=fields,
+        Conditions=conditions,
+        ExpiresIn=PRESIGNED_UPLOAD_EXPIRATION
+    )
+
+    # Store metadata in DynamoDB
+    logger.info("Store metadata in DynamoDB...")
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    images_table.put_item(
+        Item={
+            'user_id': user_id,
+            'image_id': new_image_id,
+            'status': 'processing',
+            'contentType': content_type,
+            'uploadTime': metadata['uploadTime'],
+            'originalName': file_name,
+            'filename': file_name,
+            's3Key': s3_key,
+            'likes': 0,
+            'blog_space_id': blog_space_id
+        }
+    )
+
+    return {
+        'statusCode': 200,
+        'headers': myHeaders,
+        'body': json.dumps({
+            'message': 'Upload initiated',
+            'imageId': new_image_id,
+            'upload': presigned_post,
+            'maxSize': MAX_DIRECT_UPLOAD_SIZE,
+            'expiresIn': PRESIGNED_UPLOAD_EXPIRATION
+        })
+    }
+
+
+def multipart_response(status_code, body):
+    return {
+        'statusCode': status_code,
+        'headers': myHeaders,
+        'body': json.dumps(body)
+    }
+
+
+def get_multipart_row(user_id, image_id):
+    # the row is the only place the upload id lives, so a user can only
+    # touch multipart uploads that belong to them
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    response = images_table.get_item(
+        Key={
+            'user_id': user_id,
+            'image_id': image_id
+        }
+    )
+    item = response.get('Item')
+    if not item or item.get('status') != 'uploading' or 'upload_id' not in item:
+        return None
+    return item
+
+
+def create_multipart_upload(event, user_id, body):
+    logger.info("creating multipart upload...")
+
+    file_name = body.get('fileName') or body.get('filename')
+    content_type = body.get('contentType') or body.get('content-type')
+
+    if not file_name:
+        return multipart_response(400, {'error': 'Filename not provided'})
+
+    if not content_type or not content_type.startswith('image/'):
+        return multipart_response(400, {'error': 'File must be an image'})
+
+    try:
+        file_size = int(body.get('size', 0))
+    except (TypeError, ValueError):
+        return multipart_response(400, {'error': 'Invalid size'})
+
+    if file_size <= 0 or file_size > MAX_MULTIPART_UPLOAD_SIZE:
+        return multipart_response(400, {'error': f'size must be between 1 and {MAX_MULTIPART_UPLOAD_SIZE} bytes'})
+
+    total_parts = max(1, -(-file_size // MULTIPART_PART_SIZE))  # ceiling division
+    if total_parts > MAX_MULTIPART_PARTS:
+        return multipart_response(400, {'error': 'File is too large for a multipart upload'})
+
+    blog_space_id = get_blog_space_id(event, body)
+    s3_key, new_image_id = new_upload_key(user_id, file_name)
+    metadata = upload_metadata(user_id, new_image_id, file_name, blog_space_id)
+
+    response = s3.create_multipart_upload(
+        Bucket=os.environ['STAGE_BUCKET'],
+        Key=s3_key,
+        ContentType=content_type,
+        Metadata=metadata
+    )
+    upload_id = response['UploadId']
+    logger.info(f"upload id => {upload_id}")
+
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    images_table.put_item(
+        Item={
+            'user_id': user_id,
+            'image_id': new_image_id,
+            'status': 'uploading',
+            'contentType': content_type,
+            'uploadTime': metadata['uploadTime'],
+            'originalName': file_name,
+            'filename': file_name,
+            'size': file_size,
+            's3Key': s3_key,
+            'likes': 0,
+            'blog_space_id': blog_space_id,
+            'upload_id': upload_id,
+            'total_parts': total_parts,
+            'parts_uploaded': 0,
+            'bytes_uploaded': 0
+        }
+    )
+
+    return multipart_response(200, {
+        'message': 'Multipart upload created',
+        'imageId': new_image_id,
+        'partSize': MULTIPART_PART_SIZE,
+        'totalParts': total_parts
+    })
+
+
+def presign_upload_parts(user_id, image_id, body):
+    logger.info("presigning upload parts...")
+
+    part_numbers = body.get('partNumbers')
+    if (not isinstance(part_numbers, list) or not part_numbers
+            or len(part_numbers) > MAX_PARTS_PER_REQUEST
+            or not all(isinstance(n, int) and 1 <= n <= MAX_MULTIPART_PARTS for n in part_numbers)):
+        return multipart_response(400, {'error': f'partNumbers must be a list of up to {MAX_PARTS_PER_REQUEST} part numbers'})
+
+    item = get_multipart_row(user_id, image_id)
+    if item is None:
+        return multipart_response(404, {'error': 'Multipart upload not found'})
+
+    # only the parts the declared size needs
+    if max(part_numbers) > item['total_parts']:
+        return multipart_response(400, {'error': f"this upload has {item['total_parts']} parts"})
+
+    parts = []
+    for part_number in part_numbers:
+        url = s3.generate_presigned_url(
+            'upload_part',
+            Params={
+                'Bucket': os.environ['STAGE_BUCKET'],
+                'Key': item['s3Key'],
+                'UploadId': item['upload_id'],
+                'PartNumber': part_number
+            },
+            ExpiresIn=PRESIGNED_UPLOAD_EXPIRATION
+        )
+        parts.append({'partNumber': part_number, 'url': url})
+
+    # clients ask for URLs as they go, so this keeps the progress current
+    record_progress(user_id, image_id, get_uploaded_parts(item))
+
+    return multipart_response(200, {
+        'imageId': image_id,
+        'parts': parts,
+        'expiresIn': PRESIGNED_UPLOAD_EXPIRATION
+    })
+
+
+def get_uploaded_parts(item):
+    # part number -> size of the parts S3 has received so far
+    sizes = {}
+    paginator = s3.get_paginator('list_parts')
+    for page in paginator.paginate(Bucket=os.environ['STAGE_BUCKET'], Key=item['s3Key'], UploadId=item['upload_id']):
+        for part in page.get('Parts', []):
+            sizes[part['PartNumber']] = part['Size']
+    return sizes
+
+
+def record_progress(user_id, image_id, uploaded_parts):
+    # progress for the gallery, from what S3 actually received
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    try:
+        images_table.update_item(
+            Key={
+                'user_id': user_id,
+                'image_id': image_id
+            },
+            UpdateExpression='SET parts_uploaded = :parts, bytes_uploaded = :bytes',
+            ConditionExpression='#status = :uploading',
+            ExpressionAttributeNames={
+                '#status': 'status'
+            },
+            ExpressionAttributeValues={
+                ':parts': len(uploaded_parts),
+                ':bytes': sum(uploaded_parts.values()),
+                ':uploading': 'uploading'
+            }
+        )
+    except images_table.meta.client.exceptions.ConditionalCheckFailedException:
+        logger.info(f"{image_id} is no longer uploading, not recording progress")
+
+
+def get_multipart_progress(user_id, image_id):
+    logger.info("reading multipart upload progress...")
+
+    item = get_multipart_row(user_id, image_id)
+    if item is None:
+        return multipart_response(404, {'error': 'Multipart upload not found'})
+
+    uploaded_parts = get_uploaded_parts(item)
+    record_progress(user_id, image_id, uploaded_parts)
+
+    return multipart_response(200, {
+        'imageId': image_id,
+        'size': int(item['size']),
+        'totalParts': int(item['total_parts']),
+        'partsUploaded': len(uploaded_parts),
+        'bytesUploaded': sum(uploaded_parts.values())
+    })
+
+
+def complete_multipart_upload(user_id, image_id, body):
+    logger.info("completing multipart upload...")
+
+    parts = body.get('parts')
+    if not isinstance(parts, list) or not parts:
+        return multipart_response(400, {'error': 'parts must be a list of {partNumber, eTag}'})
+
+    try:
+        completed_parts = sorted(
+            ({'PartNumber': int(part['partNumber']), 'ETag': part['eTag']} for part in parts),
+            key=lambda part: part['PartNumber']
+        )
+    except (KeyError, TypeError, ValueError):
+        return multipart_response(400, {'error': 'parts must be a list of {partNumber, eTag}'})
+
+    item = get_multipart_row(user_id, image_id)
+    if item is None:
+        return multipart_response(404, {'error': 'Multipart upload not found'})
+
+    # a presigned part URL does not limit how big the part is, so the
+    # declared size is checked against what S3 actually received
+    uploaded_parts = get_uploaded_parts(item)
+    uploaded_size = sum(uploaded_parts.get(part['PartNumber'], 0) for part in completed_parts)
+    if uploaded_size > item['size']:
+        return multipart_response(400, {'error': f"uploaded {uploaded_size} bytes, more than the declared size of {item['size']}"})
+
+    # the row moves to processing first, completing the upload fires the
+    # staging bucket notification and the processor expects that state
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    images_table.update_item(
+        Key={
+            'user_id': user_id,
+            'image_id': image_id
+        },
+        UpdateExpression='SET #status = :processing, parts_uploaded = :parts, bytes_uploaded = :bytes',
+        ExpressionAttributeNames={
+            '#status': 'status'
+        },
+        ExpressionAttributeValues={
+            ':processing': 'processing',
+            ':parts': len(completed_parts),
+            ':bytes': uploaded_size
+        }
+    )
+
+    try:
+        s3.complete_multipart_upload(
+            Bucket=os.environ['STAGE_BUCKET'],
+            Key=item['s3Key'],
+            UploadId=item['upload_id'],
+            MultipartUpload={'Parts': completed_parts}
+        )
+    except Exception:
+        # let the client fix the part list and try again
+        images_table.update_item(
+            Key={
+                'user_id': user_id,
+                'image_id': image_id
+            },
+            UpdateExpression='SET #status = :uploading',
+            ExpressionAttributeNames={
+                '#status': 'status'
+            },
+            ExpressionAttributeValues={
+                ':uploading': 'uploading'
+            }
+        )
+        raise
+
+    images_table.update_item(
+        Key={
+            'user_id': user_id,
+            'image_id': image_id
+        },
+        UpdateExpression='REMOVE upload_id'
+    )
+
+    return multipart_response(200, {
+        'message': 'Method completed',
+        'imageId': image_id
+    })
+
+
+def abort_multipart_upload(user_id, image_id):
+    logger.info("aborting multipart upload...")
+
+    item = get_multipart_row(user_id, image_id)
+    if item is None:
+        return multipart_response(404, {'error': 'Multipart upload not found'})
+
+    s3.abort_multipart_upload(
+        Bucket=os.environ['STAGE_BUCKET'],
+        Key=item['s3Key'],
+        UploadId=item['upload_id']
+    )
+
+    images_table = dynamodb.Table(os.environ['USER_TABLE'])
+    images_table.delete_item(
+        Key={
+            'user_id': user_id,
+            'image_id': image_id
+        }
+    )
+
+    return multipart_response(200, {
+        'message': 'Multipart upload aborted',
+        'imageId': image_id
+    })
+
+
+def handle_multipart(event, user_id):
+    method = event.get('httpMethod')
+    resource = event.get('resource')
+    path_params = event.get('pathParameters') or {}
+    image_id = path_params.get('image_id')
+
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except json.JSONDecodeError:
+        return multipart_response(400, {'error': 'Invalid JSON body'})
+
+    if resource == '/images/upload/multipart' and method == 'POST':
+        return create_multipart_upload(event, user_id, body)
+
+    if image_id is None:
+        return multipart_response(400, {'error': 'Invalid image ID'})
+
+    if resource.endswith('/parts') and method == 'POST':
+        return presign_upload_parts(user_id, image_id, body)
+
+    if resource.endswith('/complete') and method == 'POST':
+        return complete_multipart_upload(user_id, image_id, body)
+
+    if method == 'GET':
+        return get_multipart_progress(user_id, image_id)
+
+    if method == 'DELETE':
+        return abort_multipart_upload(user_id, image_id)
+
+    return multipart_response(405, {'error': 'Method not allowed'})
+
 
 def lambda_handler(event, context):
     logger.info("uploading images started...")
@@ -31,6 +488,12 @@ def lambda_handler(event, context):
         user_id = event['requestContext']['authorizer']['claims']['sub']
         user_email = event['requestContext']['authorizer']['claims']['email']
         user_id = user_email
+
+        if event.get('resource') == '/images/upload/initiate':
+            return initiate_upload(event, user_id)
+
+        if (event.get('resource') or '').startswith('/images/upload/multipart'):
+            return handle_multipart(event, user_id)
         
         # Get the image data from the request
         if 'body' not in event or not event['body']:
@@ -41,7 +504,7 @@ def lambda_handler(event, context):
             }
         
         file_content = event['body']
-        logger.info(f"file content is : {file_content}")
+        logger.info(f"file content length is : {len(file_content)}")
 
         # 'content-type': 'image/jpeg', 'filename': 'waterBottle.jpg
 
@@ -89,45 +552,16 @@ def lambda_handler(event, context):
                     'body': json.dumps({'error': 'File size exceeds 6MB limit'})
                 }
             
-            # Generate unique image ID
-            image_id = str(uuid.uuid4())
-
-            # Generate S3 key (folder structure: user_id/filename)
-            custom_file_name  = image_id + "_" + file_name
-
             # using the user_email as the user id
             user_id = user_email
-            s3_key = f"{user_id}/{custom_file_name}"
-
-            new_image_id = custom_file_name.split('.')[0]  # [su8792xuI_flower] [.jpg]
-
-            # Check if the prams constains the blog id
-            if event and "queryStringParameters" in event and event["queryStringParameters"]:
-                query_params = event["queryStringParameters"]
-                logger.info(f"Query parameters: {query_params}")
+            s3_key, new_image_id = new_upload_key(user_id, file_name)
+            blog_space_id = get_blog_space_id(event)
 
-                if "blog_space_id" in query_params:
-                    blog_space_id = query_params["blog_space_id"]
-                else:
-                    blog_space_id = "no id"
-
-
-            logger.info("Upload to staging bucket...")
-            s3.put_object(
-                Bucket=os.environ['STAGE_BUCKET'],
-                Key=s3_key,
-                Body=file_content,
-                ContentType=content_type,
-                Metadata={
-                    'user_id': user_id, # this is the user email now
-                    'uploadTime': datetime.now().isoformat(),
-                    'image_id': new_image_id,
-                    'originalName': file_name,
-                    'blog_space_id': blog_space_id
-                }
-            )
 
             # Store metadata in DynamoDB
+            # the row goes in before the object, the staging notification
+            # can reach the processor before this function returns and the
+            # processor's claim must not be overwritten by this write
             logger.info("Store metadata in DynamoDB...")
             images_table = dynamodb.Table(os.environ['USER_TABLE'])
             images_table.put_item(
@@ -147,6 +581,25 @@ def lambda_handler(event, context):
                 }
             )
 
+            logger.info("Upload to staging bucket...")
+            try:
+                s3.put_object(
+                    Bucket=os.environ['STAGE_BUCKET'],
+                    Key=s3_key,
+                    Body=file_content,
+                    ContentType=content_type,
+                    Metadata=upload_metadata(user_id, new_image_id, file_name, blog_space_id)
+                )
+            except Exception:
+                # no object means nothing will ever process the row
+                images_table.delete_item(
+                    Key={
+                        'user_id': user_id,
+                        'image_id': new_image_id
+                    }
+                )
+                raise
+
         else:
             logger.info("was not base64 encoded ")
             return {
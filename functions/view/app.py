@@ -3,7 +3,9 @@ import boto3
 import base64
 import uuid
 import os
+import time
 from datetime import datetime, timedelta
+from functools import lru_cache
 import logging
 from boto3.dynamodb.conditions import Key
 import decimal
@@ -11,12 +13,31 @@ import decimal
 
 s3 = boto3.client('s3')
 dynamodb = boto3.resource('dynamodb')
+ssm = boto3.client('ssm')
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 SHARE_LINK_EXPIRATION = 10800  # 3 hours in seconds
 EXPIRATION_FOR_AUTH_USERS = 60  * 60 * 24 # 24 hours in seconds
+PRESIGN_BUCKET_SECONDS = int(os.environ.get('PRESIGN_BUCKET_SECONDS', 3600)) # 1 hour in seconds
+
+DEFAULT_PAGE_SIZE = 50
+DELETION_MODE_INDEX = 'DeletionModeIndex'
+# the index comes with its own deploy and is only read once the reconcile job
+# has backfilled the index key on older rows, until then listings read the
+# table and filter on deletion_mode
+DELETION_MODE_INDEX_ENABLED = os.environ.get('DELETION_MODE_INDEX', 'disabled') == 'enabled'
+BACKFILL_STATUS_PARAMETER = os.environ.get('BACKFILL_STATUS_PARAMETER')
+BACKFILL_STATUS_SECONDS = 300  # how long a container trusts a "not done yet"
+LISTING_DELETION_MODES = ['none', 'soft', 'all']
+MAX_PAGE_SIZE = 200
+
+# only the fields the gallery renders are read for listings
+LISTING_ATTRIBUTES = [
+    'user_id', 'image_id', 's3Key', 'url', 'status', 'contentType', 'createdAt', 'uploadTime',
+    'originalName', 'size', 'likes', 'deletion_mode', 'blog_space_id', 'metadata', 'renditions'
+]
 
 domain_name = "main.d17gnlmjpnk7at.amplifyapp.com"
 stage = "prod"
@@ -29,6 +50,35 @@ myHeaders = {
 }
 
 
+@lru_cache(maxsize=4096)
+def presign_in_time_bucket(bucket_name, s3_key, expires_in, time_bucket):
+    # every request in the same time bucket gets the same URL, so browsers
+    # and CloudFront can cache it. It stays valid for expires_in seconds
+    # after the bucket closes, never less than what was asked for
+    bucket_end = (time_bucket + 1) * PRESIGN_BUCKET_SECONDS
+    return s3.generate_presigned_url(
+        'get_object',
+        Params={
+            'Bucket': bucket_name,
+            'Key': s3_key
+        },
+        ExpiresIn=int(bucket_end + expires_in - time.time())
+    )
+
+
+def get_presigned_url(s3_key, expires_in):
+    time_bucket = int(time.time() // PRESIGN_BUCKET_SECONDS)
+    return presign_in_time_bucket(os.environ['PROCESSED_BUCKET'], s3_key, expires_in, time_bucket)
+
+
+def get_rendition_urls(item, expires_in):
+    # size -> presigned URL of each smaller copy, the gallery picks the one that fits the tile
+    return {
+        size: get_presigned_url(rendition_key, expires_in)
+        for size, rendition_key in item.get('renditions', {}).items()
+    }
+
+
 def handle_shared_image_access(share_token):
     # Get sharing record from DynamoDB
     logger.info("handle_shared_image_access invoked")
@@ -118,7 +168,7 @@ def get_single_image(user_id, image_id, table, generate_share=False):
 
     logger.info(f"Response from DynamoDB: {response}")
 
-    if 'Item' not in response:
+    if 'Item' not in response or response['Item'].get('deletion_mode') == 'pending_delete':
         return {
             'statusCode': 404,
             'headers': myHeaders,
@@ -131,29 +181,15 @@ def get_single_image(user_id, image_id, table, generate_share=False):
     s3_key = item.get('s3Key')
     logger.info(f"s3_key => {s3_key}")
 
-    presigned_url = s3.generate_presigned_url(
-        'get_object',
-        Params={
-            'Bucket': os.environ['PROCESSED_BUCKET'],
-            'Key': s3_key
-        },
-        ExpiresIn=EXPIRATION_FOR_AUTH_USERS  # URL valid for 1 hour for authenticated users
-    )
-
-    # for guests
-    presigned_url_guest = s3.generate_presigned_url(
-        'get_object',
-        Params={
-            'Bucket': os.environ['PROCESSED_BUCKET'],
-            'Key': s3_key
-        },
-        ExpiresIn=SHARE_LINK_EXPIRATION  # URL valid for 1 hour for authenticated users
-    )
+    presigned_url = get_presigned_url(s3_key, EXPIRATION_FOR_AUTH_USERS)
 
     item['presignedUrl'] = presigned_url
+    item['renditionUrls'] = get_rendition_urls(item, EXPIRATION_FOR_AUTH_USERS)
 
     # Generate sharing link if requested
     if generate_share:
+        # for guests
+        presigned_url_guest = get_presigned_url(s3_key, SHARE_LINK_EXPIRATION)
         share_info = generate_share_link(user_id, image_id, item.get('metadata', {}), presigned_url_guest)
         logger.info(f"share_info => {share_info}")
         item['shareInfo'] = share_info
@@ -172,58 +208,127 @@ def decimal_default(obj):
     raise TypeError("Type not serializable")
 
 
-def get_all_user_images(user_id, table):
-    # List all user's processed images
+def encode_page_token(last_evaluated_key):
+    # opaque to the client, it is just the DynamoDB position
+    return base64.urlsafe_b64encode(json.dumps(last_evaluated_key, default=decimal_default).encode()).decode()
+
+
+def decode_page_token(token, user_id, index_key=None):
+    last_evaluated_key = json.loads(base64.urlsafe_b64decode(token.encode()).decode())
+    if not isinstance(last_evaluated_key, dict) or last_evaluated_key.get('user_id') != user_id:
+        raise ValueError("page token does not belong to this user")
+    if last_evaluated_key.get('user_deletion_mode') != index_key:
+        raise ValueError("page token belongs to another deletion_mode")
+    return last_evaluated_key
+
+
+# the backfill never goes back to pending, so once complete it is never read again
+backfill_status = {'complete': False, 'checked_at': 0}
+
+
+def deletion_mode_index_ready():
+    if not DELETION_MODE_INDEX_ENABLED or not BACKFILL_STATUS_PARAMETER:
+        return False
+    now = time.time()
+    if not backfill_status['complete'] and now - backfill_status['checked_at'] >= BACKFILL_STATUS_SECONDS:
+        backfill_status['checked_at'] = now
+        try:
+            value = ssm.get_parameter(Name=BACKFILL_STATUS_PARAMETER)['Parameter']['Value']
+            backfill_status['complete'] = value == 'complete'
+        except Exception as e:
+            # not written before the first complete reconcile pass
+            logger.info(f"backfill status not available: {str(e)}")
+    return backfill_status['complete']
+
+
+def get_all_user_images(user_id, table, query_params=None):
+    # List one page of the user's processed images
     logger.info(f"Getting all images for user {user_id}")
-    response = table.query(
-        KeyConditionExpression=Key('user_id').eq(user_id),
-        FilterExpression='attribute_exists(#url_attr)',
-        ExpressionAttributeNames={
-            '#url_attr': 'url'
+    query_params = query_params or {}
+
+    # live images by default, soft deleted ones for the trash view, or all of them
+    deletion_mode = query_params.get('deletion_mode', 'none')
+    if deletion_mode not in LISTING_DELETION_MODES:
+        return {
+            'statusCode': 400,
+            'headers': myHeaders,
+            'body': json.dumps({'error': 'Invalid deletion_mode parameter'})
+        }
+    index_key = f"{user_id}#{deletion_mode}" if deletion_mode != 'all' and deletion_mode_index_ready() else None
+
+    try:
+        page_size = min(max(int(query_params.get('limit', DEFAULT_PAGE_SIZE)), 1), MAX_PAGE_SIZE)
+        start_key = decode_page_token(query_params['next_token'], user_id, index_key) if query_params.get('next_token') else None
+    except (TypeError, ValueError) as e:
+        logger.info(f"Invalid pagination parameters: {str(e)}")
+        return {
+            'statusCode': 400,
+            'headers': myHeaders,
+            'body': json.dumps({'error': 'Invalid limit or next_token'})
         }
-    )
-    logger.info(f"Response from DynamoDB: {response}")
 
-    items = response.get('Items', [])
-    # Generate presigned URLs for each image
+    query_kwargs = {
+        'ProjectionExpression': ', '.join(f'#{name}' for name in LISTING_ATTRIBUTES),
+        'ExpressionAttributeNames': {f'#{name}': name for name in LISTING_ATTRIBUTES}
+    }
+    if index_key:
+        # the sparse index only holds processed images of one deletion_mode,
+        # so nothing else is read, let alone filtered out
+        query_kwargs['IndexName'] = DELETION_MODE_INDEX
+        query_kwargs['KeyConditionExpression'] = Key('user_deletion_mode').eq(index_key)
+    elif deletion_mode == 'all':
+        query_kwargs['KeyConditionExpression'] = Key('user_id').eq(user_id)
+        # hard deleted images wait for the purge worker, never list them
+        query_kwargs['FilterExpression'] = 'attribute_exists(#url) AND (attribute_not_exists(#deletion_mode) OR #deletion_mode <> :pending)'
+        query_kwargs['ExpressionAttributeValues'] = {':pending': 'pending_delete'}
+    elif deletion_mode == 'none':
+        query_kwargs['KeyConditionExpression'] = Key('user_id').eq(user_id)
+        query_kwargs['FilterExpression'] = 'attribute_exists(#url) AND (attribute_not_exists(#deletion_mode) OR #deletion_mode = :mode)'
+        query_kwargs['ExpressionAttributeValues'] = {':mode': 'none'}
+    else:
+        query_kwargs['KeyConditionExpression'] = Key('user_id').eq(user_id)
+        query_kwargs['FilterExpression'] = 'attribute_exists(#url) AND #deletion_mode = :mode'
+        query_kwargs['ExpressionAttributeValues'] = {':mode': deletion_mode}
+
+    # Limit is applied before any filter, so keep reading until the page is
+    # full or the partition is exhausted. Asking only for what is missing
+    # keeps LastEvaluatedKey an exact resume point
+    items = []
+    while True:
+        query_kwargs['Limit'] = page_size - len(items)
+        if start_key:
+            query_kwargs['ExclusiveStartKey'] = start_key
+        response = table.query(**query_kwargs)
+        items.extend(response.get('Items', []))
+        start_key = response.get('LastEvaluatedKey')
+        if not start_key or len(items) >= page_size:
+            break
+
+    logger.info(f"Read {len(items)} images, more pages: {start_key is not None}")
+
+    # Generate presigned URLs for each image, signing is local so the
+    # listing costs no extra round trips. Missing objects are flagged on
+    # the item by the reconcile job instead of a head_object per image
     logger.info("Generating presigned URLs for each image")
     for item in items:
 
-        logger.info(f"item => {item}")
-
         s3_key = item['s3Key']
-        logger.info(f"s3_key => {s3_key}")
 
-        try:
-            # Check if the object exists first
-            s3.head_object(
-                Bucket=os.environ['PROCESSED_BUCKET'],
-                Key= s3_key
-            )
-
-            presigned_url = s3.generate_presigned_url(
-                'get_object',
-                Params={
-                    'Bucket': os.environ['PROCESSED_BUCKET'],
-                    'Key': s3_key
-                },
-                ExpiresIn=EXPIRATION_FOR_AUTH_USERS
-            )
-            item['presignedUrl'] = presigned_url
-            logger.info(f"presignedUrl => {presigned_url}" )
-            # update
-            table.put_item(Item=item)
-        except Exception as e:
-            logger.error(f"Error generating presigned URL: {str(e)}")
+        if item.get('status') == 'image_not_found':
             item['presignedUrl'] = None
-            item['status'] = 'image_not_found'
+            item['renditionUrls'] = {}
+            continue
+
+        item['presignedUrl'] = get_presigned_url(s3_key, EXPIRATION_FOR_AUTH_USERS)
+        item['renditionUrls'] = get_rendition_urls(item, EXPIRATION_FOR_AUTH_USERS)
 
     return {
         'statusCode': 200,
         'headers': myHeaders,
         'body': json.dumps({
             'images': items,
-            'count': len(items)
+            'count': len(items),
+            'nextToken': encode_page_token(start_key) if start_key else None
         }, default=decimal_default)
     }
 
@@ -262,6 +367,7 @@ def lambda_handler(event, context):
 
             generate_share = "generate_share" in query_params and query_params["generate_share"] == "true"
         else:
+            query_params = {}
             generate_share = False
 
         logger.info(f"Image ID: {image_id}")
@@ -280,7 +386,7 @@ def lambda_handler(event, context):
             return get_single_image(user_id, image_id, table, generate_share)
         else:
             
-            return get_all_user_images(user_id, table)
+            return get_all_user_images(user_id, table, query_params)
         
     except Exception as e:
         logger.info(f"Error: {str(e)}")
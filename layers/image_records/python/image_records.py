@@ -0,0 +1,216 @@
+import json
+import boto3
+import os
+import time
+import logging
+from boto3.dynamodb.conditions import Key
+from concurrent.futures import ThreadPoolExecutor
+
+# helpers the delete, restore, sweeper and purge functions share, shipped to
+# them as the ImageRecordsLayer
+
+dynamodb = boto3.resource('dynamodb')
+sqs = boto3.client('sqs')
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+IMAGE_SHARING_INDEX = 'ImageIdIndex'
+BATCH_WRITE_SIZE = 25  # DynamoDB BatchWriteItem limit
+TRANSACT_WRITE_SIZE = 100  # DynamoDB TransactWriteItems limit
+BATCH_GET_SIZE = 100  # DynamoDB BatchGetItem limit
+SQS_BATCH_SIZE = 10  # SQS SendMessageBatch limit
+WRITE_WORKERS = 8
+MAX_WRITE_RETRIES = 5
+MAX_BULK_IMAGES = 1000
+# soft delete bookkeeping on a user image row: soft_deleted and purge_at key the
+# sparse SoftDeletedIndex read by the sweeper
+SOFT_DELETE_FIELDS = ('soft_deleted', 'purge_at')
+# "<user_id>#<deletion_mode>", the key of the sparse DeletionModeIndex the gallery
+# lists from, removed once an image is pending_delete
+DELETION_MODE_INDEX_FIELD = 'user_deletion_mode'
+
+
+def chunk_list(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def get_image_share_tokens(image_sharing_table, user_id, image_id):
+    # only the shares of this image, through the image_id index instead of
+    # scanning every share on the platform
+    share_tokens = []
+    query_kwargs = {
+        'IndexName': IMAGE_SHARING_INDEX,
+        'KeyConditionExpression': Key('image_id').eq(image_id) & Key('user_id').eq(user_id)
+    }
+    while True:
+        response = image_sharing_table.query(**query_kwargs)
+        share_tokens.extend(item['share_token'] for item in response.get('Items', []))
+        if 'LastEvaluatedKey' not in response:
+            break
+        query_kwargs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    logger.info(f"Found {len(share_tokens)} shares for image {image_id}")
+    return share_tokens
+
+
+def get_shares_of_images(image_sharing_table, user_id, image_ids):
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        share_tokens = pool.map(lambda image_id: get_image_share_tokens(image_sharing_table, user_id, image_id), image_ids)
+        return [{'share_token': share_token} for tokens in share_tokens for share_token in tokens]
+
+
+def batch_delete_items(table_name, keys):
+    # BatchWriteItem in chunks of 25, retrying whatever comes back unprocessed.
+    # The resource's client converts plain python values to and from DynamoDB types
+    for chunk in chunk_list(keys, BATCH_WRITE_SIZE):
+        request_items = {
+            table_name: [{'DeleteRequest': {'Key': key}} for key in chunk]
+        }
+        for retry in range(MAX_WRITE_RETRIES):
+            response = dynamodb.meta.client.batch_write_item(RequestItems=request_items)
+            request_items = response.get('UnprocessedItems') or {}
+            if not request_items:
+                break
+            time.sleep(min(0.05 * 2 ** retry, 1))
+        if request_items:
+            raise Exception(f"{len(request_items[table_name])} deletes left unprocessed in {table_name}")
+
+
+def transact_deletion_mode_chunk(table_name, keys, deletion_mode, set_fields=None, remove_fields=(), from_mode=None, except_mode=None):
+    # one TransactWriteItems call, an update only applies to items that still
+    # exist so a share removed in the meantime is not recreated, with from_mode
+    # only to items still in that deletion_mode and with except_mode only to
+    # items not in that one. Returns the keys that were skipped for failing that check
+    set_fields = set_fields or {}
+    update_expression = 'SET deletion_mode = :val' + ''.join(f', {name} = :{name}' for name in set_fields)
+    if remove_fields:
+        update_expression += ' REMOVE ' + ', '.join(remove_fields)
+    expression_values = {':val': deletion_mode, **{f':{name}': value for name, value in set_fields.items()}}
+    condition = 'attribute_exists(#pk)'
+    if from_mode:
+        condition += ' AND deletion_mode = :from_mode'
+        expression_values[':from_mode'] = from_mode
+    if except_mode:
+        condition += ' AND (attribute_not_exists(deletion_mode) OR deletion_mode <> :except_mode)'
+        expression_values[':except_mode'] = except_mode
+    skipped_keys = []
+    for retry in range(MAX_WRITE_RETRIES):
+        if not keys:
+            return skipped_keys
+        try:
+            dynamodb.meta.client.transact_write_items(
+                TransactItems=[
+                    {
+                        'Update': {
+                            'TableName': table_name,
+                            'Key': key,
+                            'UpdateExpression': update_expression,
+                            'ConditionExpression': condition,
+                            'ExpressionAttributeNames': {'#pk': next(iter(key))},
+                            'ExpressionAttributeValues': expression_values
+                        }
+                    }
+                    for key in keys
+                ]
+            )
+            return skipped_keys
+        except dynamodb.meta.client.exceptions.TransactionCanceledException as e:
+            reasons = e.response.get('CancellationReasons', [])
+            if len(reasons) == len(keys):
+                # drop the items that failed the check and retry the rest
+                skipped_keys.extend(key for key, reason in zip(keys, reasons) if reason.get('Code') == 'ConditionalCheckFailed')
+                keys = [key for key, reason in zip(keys, reasons) if reason.get('Code') != 'ConditionalCheckFailed']
+            logger.info(f"Transaction cancelled, retrying {len(keys)} updates: {str(e)}")
+            time.sleep(min(0.05 * 2 ** retry, 1))
+    raise Exception(f"could not update deletion_mode for {len(keys)} items in {table_name}")
+
+
+def transact_set_deletion_mode(table_name, keys, deletion_mode, set_fields=None, remove_fields=(), from_mode=None):
+    # chunks of 100 (the TransactWriteItems limit), written in parallel
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        skipped_chunks = pool.map(
+            lambda chunk: transact_deletion_mode_chunk(table_name, chunk, deletion_mode, set_fields, remove_fields, from_mode),
+            chunk_list(keys, TRANSACT_WRITE_SIZE)
+        )
+        return [key for skipped_keys in skipped_chunks for key in skipped_keys]
+
+
+def batch_get_chunk(table_name, keys, projection):
+    # one BatchGetItem call, retrying whatever DynamoDB hands back unprocessed
+    request_items = {
+        table_name: {
+            'Keys': keys,
+            'ProjectionExpression': projection
+        }
+    }
+    items = []
+    for retry in range(MAX_WRITE_RETRIES):
+        response = dynamodb.meta.client.batch_get_item(RequestItems=request_items)
+        items.extend(response['Responses'].get(table_name, []))
+        request_items = response.get('UnprocessedKeys') or {}
+        if not request_items:
+            return items
+        time.sleep(min(0.05 * 2 ** retry, 1))
+    raise Exception(f"{len(request_items[table_name]['Keys'])} reads left unprocessed in {table_name}")
+
+
+def batch_get_items(table_name, keys, projection):
+    # chunks of 100 (the BatchGetItem limit), read in parallel
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as pool:
+        chunks = pool.map(lambda chunk: batch_get_chunk(table_name, chunk, projection), chunk_list(keys, BATCH_GET_SIZE))
+        return [item for chunk in chunks for item in chunk]
+
+
+def get_bulk_image_ids(event):
+    # body of the bulk endpoints: {"image_ids": [...], ...}.
+    # Returns the image ids, the body and an error message for a 400
+    try:
+        body = json.loads(event.get('body') or '{}')
+    except json.JSONDecodeError:
+        return None, None, 'Invalid JSON body'
+
+    image_ids = body.get('image_ids')
+    if (not isinstance(image_ids, list) or not image_ids or len(image_ids) > MAX_BULK_IMAGES
+            or not all(isinstance(image_id, str) and image_id for image_id in image_ids)):
+        return None, None, f'image_ids must be a list of 1 to {MAX_BULK_IMAGES} image IDs'
+
+    # duplicates would make the batch calls fail
+    return list(dict.fromkeys(image_ids)), body, None
+
+
+def purge_message(item):
+    # everything the purge worker needs, so it never reads the row again.
+    # A duplicate upload shares the objects of the image it duplicates,
+    # only its row goes
+    duplicate = bool(item.get('duplicate_of'))
+    s3_keys = []
+    if not duplicate:
+        s3_keys = [item['s3Key']] if item.get('s3Key') else []
+        s3_keys.extend(item.get('renditions', {}).values())
+    return {
+        'user_id': item['user_id'],
+        'image_id': item['image_id'],
+        's3_keys': s3_keys,
+        'content_hash': item.get('content_hash'),
+        'duplicate': duplicate
+    }
+
+
+def enqueue_purge(items):
+    # hands hard deletes to the purge worker, returns the image ids that could not be queued
+    failed_ids = []
+    for chunk in chunk_list(items, SQS_BATCH_SIZE):
+        try:
+            response = sqs.send_message_batch(
+                QueueUrl=os.environ['PURGE_QUEUE_URL'],
+                Entries=[
+                    {'Id': str(index), 'MessageBody': json.dumps(purge_message(item))}
+                    for index, item in enumerate(chunk)
+                ]
+            )
+            failed_ids.extend(chunk[int(failure['Id'])]['image_id'] for failure in response.get('Failed', []))
+        except Exception as e:
+            logger.error(f"Error queueing purge: {str(e)}")
+            failed_ids.extend(item['image_id'] for item in chunk)
+    return failed_ids
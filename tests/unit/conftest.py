@@ -0,0 +1,64 @@
+import importlib
+import importlib.util
+import os
+import sys
+from functools import lru_cache
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), '..', '..')
+LAYER_PATHS = [os.path.join(ROOT, 'layers', 'image_records', 'python')]
+
+# the module level boto3 clients only need a region to be created
+os.environ.setdefault('AWS_DEFAULT_REGION', 'eu-west-1')
+
+
+@lru_cache(maxsize=None)
+def load_function(name):
+    # every function's handler module is called app, so each one is loaded
+    # under its own name. Its other modules and the layers import as they do in Lambda
+    function_dir = os.path.join(ROOT, 'functions', name)
+    for path in [function_dir] + LAYER_PATHS:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    spec = importlib.util.spec_from_file_location(f'{name}_app', os.path.join(function_dir, 'app.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+@pytest.fixture()
+def process_app():
+    return load_function('process')
+
+
+@pytest.fixture()
+def retry_policy():
+    load_function('process')
+    return importlib.import_module('retry_policy')
+
+
+@pytest.fixture()
+def view_app():
+    return load_function('view')
+
+
+@pytest.fixture()
+def purge_app():
+    return load_function('purge')
+
+
+@pytest.fixture()
+def image_records():
+    load_function('purge')
+    return importlib.import_module('image_records')
+
+
+@pytest.fixture()
+def reconcile_app():
+    return load_function('reconcile')
+
+
+@pytest.fixture()
+def upload_app():
+    return load_function('upload')
@@ -0,0 +1,37 @@
+from unittest import mock
+
+import pytest
+
+
+class TransactionCanceled(Exception):
+    def __init__(self, reasons):
+        super().__init__("Transaction cancelled")
+        self.response = {'CancellationReasons': reasons}
+
+
+@pytest.fixture()
+def client(image_records, monkeypatch):
+    dynamodb = mock.Mock()
+    dynamodb.meta.client.exceptions.TransactionCanceledException = TransactionCanceled
+    monkeypatch.setattr(image_records, 'dynamodb', dynamodb)
+    monkeypatch.setattr(image_records.time, 'sleep', lambda seconds: None)
+    return dynamodb.meta.client
+
+
+def test_items_already_pending_delete_are_skipped(image_records, client):
+    keys = [{'user_id': 'alice', 'image_id': 'img1'}, {'user_id': 'alice', 'image_id': 'img2'}]
+    client.transact_write_items.side_effect = [
+        TransactionCanceled([{'Code': 'None'}, {'Code': 'ConditionalCheckFailed'}]),
+        None
+    ]
+
+    skipped = image_records.transact_deletion_mode_chunk('images', keys, 'pending_delete', except_mode='pending_delete')
+
+    assert skipped == [keys[1]]
+    first, retry = [call.kwargs['TransactItems'] for call in client.transact_write_items.call_args_list]
+    update = first[0]['Update']
+    assert update['ConditionExpression'] == (
+        'attribute_exists(#pk) AND (attribute_not_exists(deletion_mode) OR deletion_mode <> :except_mode)'
+    )
+    assert update['ExpressionAttributeValues'][':except_mode'] == 'pending_delete'
+    assert [item['Update']['Key'] for item in retry] == [keys[0]]
@@ -0,0 +1,347 @@
+import io
+import json
+import threading
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+import pytest
+from PIL import Image
+
+
+def start(target, *args):
+    thread = threading.Thread(target=target, args=args, daemon=True)
+    thread.start()
+    return thread
+
+
+def sqs_record(message_id, key):
+    return {
+        'eventSource': 'aws:sqs',
+        'messageId': message_id,
+        'body': json.dumps({'bucket': 'staging', 'key': key, 'attempt': 1})
+    }
+
+
+def lambda_context(remaining_millis):
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.return_value = remaining_millis
+    return context
+
+
+def jpeg(size=(1600, 1200)):
+    output = io.BytesIO()
+    Image.new('RGB', size, (40, 90, 200)).save(output, 'JPEG')
+    return output.getvalue()
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+def conditional_table():
+    # boto3 tables raise the modeled exception class of their client
+    table = mock.Mock()
+    table.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailed
+    return table
+
+
+class FakeS3:
+    # in memory buckets, keeps what was read and written
+    def __init__(self, objects):
+        self.objects = dict(objects)
+        self.downloads = []
+        self.copies = []
+        self.deleted = []
+        self.fail_uploads = False
+
+    def get_object(self, Bucket, Key, Range=None):
+        data = self.objects[(Bucket, Key)]
+        start, end = [int(position) for position in Range.split('=')[1].split('-')]
+        part = data[start:end + 1]
+        return {
+            'Body': io.BytesIO(part),
+            'ContentType': 'image/jpeg',
+            'Metadata': {'title': 'cat'},
+            'ContentRange': f"bytes {start}-{start + len(part) - 1}/{len(data)}"
+        }
+
+    def download_fileobj(self, Bucket, Key, image_file, Config=None):
+        self.downloads.append(Key)
+        image_file.write(self.objects[(Bucket, Key)])
+
+    def upload_fileobj(self, image_file, Bucket, Key, ExtraArgs=None, Config=None):
+        if self.fail_uploads:
+            raise ConnectionError("upload failed")
+        self.objects[(Bucket, Key)] = image_file.read()
+
+    def put_object(self, Bucket, Key, Body, ContentType=None):
+        if self.fail_uploads and not Key.startswith('scratch/'):
+            raise ConnectionError("upload failed")
+        self.objects[(Bucket, Key)] = Body
+
+    def copy_object(self, Bucket, Key, CopySource, ContentType=None, MetadataDirective=None):
+        self.copies.append((CopySource['Key'], Key))
+        self.objects[(Bucket, Key)] = self.objects[(CopySource['Bucket'], CopySource['Key'])]
+
+    def delete_objects(self, Bucket, Delete):
+        for entry in Delete['Objects']:
+            self.deleted.append(entry['Key'])
+            self.objects.pop((Bucket, entry['Key']), None)
+
+
+@pytest.fixture()
+def pipeline(process_app, monkeypatch):
+    # process_image with an in memory S3 and the table writes stubbed
+    monkeypatch.setenv('PRIMARY_BUCKET', 'primary')
+    monkeypatch.setenv('USER_TABLE', 'images')
+    s3 = FakeS3({('staging', 'alice/img1.jpg'): jpeg()})
+    stubs = SimpleNamespace(
+        s3=s3,
+        claim_image=mock.Mock(return_value=('token', 1, {})),
+        publish_image=mock.Mock(return_value=True),
+        release_claim=mock.Mock(),
+        save_content_hash=mock.Mock(),
+        handle_processing_failure=mock.Mock()
+    )
+    monkeypatch.setattr(process_app, 's3', s3)
+    monkeypatch.setattr(process_app, 'get_dynamodb', mock.Mock())
+    monkeypatch.setattr(process_app, 'get_user_details', lambda user_id: {'user_name': 'Alice', 'email': user_id})
+    monkeypatch.setattr(process_app, 'get_existing_copy', lambda user_id, content_hash: None)
+    monkeypatch.setattr(process_app, 'RENDITION_SIZES', [256])
+    for name in ('claim_image', 'publish_image', 'release_claim', 'save_content_hash', 'handle_processing_failure'):
+        monkeypatch.setattr(process_app, name, getattr(stubs, name))
+    return stubs
+
+
+def test_memory_budget_admits_what_fits(process_app):
+    budget = process_app.MemoryBudget(100)
+    budget.acquire(40)
+    budget.acquire(60)
+    assert budget.in_use == 100
+
+
+def test_memory_budget_waits_for_release(process_app):
+    budget = process_app.MemoryBudget(100)
+    budget.acquire(70)
+    waiting = start(budget.acquire, 50)
+    time.sleep(0.05)
+    assert waiting.is_alive()
+
+    budget.release(70)
+    waiting.join(timeout=1)
+    assert not waiting.is_alive()
+    assert budget.in_use == 50
+
+
+def test_memory_budget_runs_oversized_image_alone(process_app):
+    budget = process_app.MemoryBudget(100)
+    budget.acquire(500)
+    assert budget.in_use == 500
+
+    waiting = start(budget.acquire, 10)
+    time.sleep(0.05)
+    assert waiting.is_alive()
+
+    budget.release(500)
+    waiting.join(timeout=1)
+    assert budget.in_use == 10
+
+
+def test_wait_all_raises_after_every_call_finished(process_app):
+    finished = []
+
+    def fail():
+        raise ValueError("boom")
+
+    def slow():
+        time.sleep(0.05)
+        finished.append(True)
+
+    with pytest.raises(ValueError):
+        process_app.wait_all([process_app.io_pool.submit(fail), process_app.io_pool.submit(slow)])
+    assert finished == [True]
+
+
+def test_batch_records_all_processed(process_app, monkeypatch):
+    processed = []
+    monkeypatch.setattr(process_app, 'process_image', lambda bucket, key, attempt, checkpoint: processed.append(key))
+
+    records = [sqs_record(f'm{i}', f'user/image{i}.jpg') for i in range(6)]
+    response = process_app.lambda_handler({'Records': records}, lambda_context(150 * 1000))
+
+    assert response == {'batchItemFailures': []}
+    assert sorted(processed) == sorted(f'user/image{i}.jpg' for i in range(6))
+
+
+def test_records_not_started_before_the_deadline_go_back(process_app, monkeypatch):
+    processed = []
+    monkeypatch.setattr(process_app, 'process_image', lambda bucket, key, attempt, checkpoint: processed.append(key))
+
+    records = [sqs_record(f'm{i}', f'user/image{i}.jpg') for i in range(3)]
+    response = process_app.lambda_handler({'Records': records}, lambda_context(process_app.MIN_START_MILLIS - 1))
+
+    assert processed == []
+    assert response == {'batchItemFailures': [{'itemIdentifier': f'm{i}'} for i in range(3)]}
+
+
+def test_failed_hand_off_is_reported(process_app, monkeypatch):
+    def process_image(bucket, key, attempt, checkpoint):
+        if key == 'user/bad.jpg':
+            raise RuntimeError("queue unavailable")
+
+    monkeypatch.setattr(process_app, 'process_image', process_image)
+
+    records = [sqs_record('good', 'user/good.jpg'), sqs_record('bad', 'user/bad.jpg')]
+    response = process_app.lambda_handler({'Records': records}, lambda_context(150 * 1000))
+
+    assert response == {'batchItemFailures': [{'itemIdentifier': 'bad'}]}
+
+
+def test_claim_returns_the_attempts_and_saved_checkpoint(process_app):
+    table = conditional_table()
+    table.update_item.return_value = {'Attributes': {
+        'attempts': Decimal(2),
+        'checkpoint': {'stage': 'fetch', 'pixels': Decimal(1920000)}
+    }}
+
+    token, attempts, checkpoint = process_app.claim_image(table, 'alice', 'img1')
+
+    assert token
+    assert attempts == 2
+    assert checkpoint == {'stage': 'fetch', 'pixels': 1920000}
+    json.dumps(checkpoint)
+    update = table.update_item.call_args.kwargs
+    assert update['ExpressionAttributeValues'][':token'] == token
+    assert 'claim_expires_at < :now' in update['ConditionExpression']
+
+
+def test_claim_held_elsewhere_returns_nothing(process_app):
+    table = conditional_table()
+    table.update_item.side_effect = ConditionalCheckFailed()
+
+    assert process_app.claim_image(table, 'alice', 'img1') == (None, None, None)
+
+
+def test_publish_without_the_claim_returns_false(process_app):
+    table = conditional_table()
+    table.update_item.side_effect = ConditionalCheckFailed()
+
+    assert process_app.publish_image(table, 'alice', 'img1', 'token', {'status': 'water-marked'}) is False
+
+
+def test_duplicate_delivery_is_skipped(process_app, pipeline):
+    pipeline.claim_image.return_value = (None, None, None)
+    pipeline.s3.get_object = mock.Mock()
+
+    process_app.process_image('staging', 'alice/img1.jpg', 1)
+
+    pipeline.s3.get_object.assert_not_called()
+    assert pipeline.s3.downloads == []
+    pipeline.publish_image.assert_not_called()
+    pipeline.handle_processing_failure.assert_not_called()
+
+
+def test_image_is_published_under_the_claim(process_app, pipeline):
+    process_app.process_image('staging', 'alice/img1.jpg', 1)
+
+    assert ('primary', 'alice/img1.jpg') in pipeline.s3.objects
+    assert ('primary', 'renditions/256/alice/img1.jpg') in pipeline.s3.objects
+    table, user_id, image_id, token, fields = pipeline.publish_image.call_args.args
+    assert (user_id, image_id, token) == ('alice', 'img1', 'token')
+    assert fields['status'] == 'water-marked'
+    assert fields['renditions'] == {'256': 'renditions/256/alice/img1.jpg'}
+    pipeline.save_content_hash.assert_called_once()
+    assert 'alice/img1.jpg' in pipeline.s3.deleted
+    pipeline.handle_processing_failure.assert_not_called()
+
+
+def test_lost_claim_leaves_the_image_to_the_other_delivery(process_app, pipeline):
+    pipeline.publish_image.return_value = False
+
+    process_app.process_image('staging', 'alice/img1.jpg', 1)
+
+    # the staging object and hash entry belong to the delivery that took over
+    pipeline.save_content_hash.assert_not_called()
+    assert pipeline.s3.deleted == []
+    pipeline.release_claim.assert_not_called()
+    pipeline.handle_processing_failure.assert_not_called()
+
+
+def rendered_checkpoint(stage='render'):
+    return {
+        'stage': stage,
+        'user_name': 'Alice',
+        'email': 'alice',
+        'source_content_type': 'image/jpeg',
+        'pixels': 1920000,
+        'metadata': {},
+        'content_hash': 'abc',
+        'content_type': 'image/jpeg',
+        'size': 1234,
+        'renditions': [256]
+    }
+
+
+def test_stage_done(process_app):
+    assert not process_app.stage_done({}, 'fetch')
+    assert process_app.stage_done({'stage': 'render'}, 'fetch')
+    assert process_app.stage_done({'stage': 'render'}, 'render')
+    assert not process_app.stage_done({'stage': 'render'}, 'publish')
+    assert not process_app.stage_done({'stage': 'unknown'}, 'fetch')
+
+
+def test_failed_publish_parks_the_rendered_output(process_app, pipeline):
+    pipeline.s3.fail_uploads = True
+
+    process_app.process_image('staging', 'alice/img1.jpg', 1)
+
+    assert ('staging', 'scratch/alice/img1.jpg') in pipeline.s3.objects
+    assert ('staging', 'scratch/renditions/256/alice/img1.jpg') in pipeline.s3.objects
+    checkpoint = pipeline.release_claim.call_args.args[4]
+    assert checkpoint['stage'] == 'render'
+    assert checkpoint['renditions'] == [256]
+    assert pipeline.handle_processing_failure.call_args.args[5] == checkpoint
+
+
+def test_unparked_output_is_rendered_again(process_app, pipeline, monkeypatch):
+    pipeline.s3.fail_uploads = True
+    monkeypatch.setattr(process_app, 'park_rendered_output', mock.Mock(side_effect=ConnectionError("put failed")))
+
+    process_app.process_image('staging', 'alice/img1.jpg', 1)
+
+    assert pipeline.release_claim.call_args.args[4]['stage'] == 'fetch'
+
+
+def test_retry_publishes_the_parked_output(process_app, pipeline):
+    parked = jpeg((800, 600))
+    pipeline.s3.objects[('staging', 'scratch/alice/img1.jpg')] = parked
+    pipeline.s3.objects[('staging', 'scratch/renditions/256/alice/img1.jpg')] = b'rendition'
+    pipeline.claim_image.return_value = ('token', 2, {})
+
+    process_app.process_image('staging', 'alice/img1.jpg', 2, rendered_checkpoint())
+
+    # copied server side, nothing is downloaded or rendered again
+    assert pipeline.s3.downloads == []
+    assert sorted(pipeline.s3.copies) == [
+        ('scratch/alice/img1.jpg', 'alice/img1.jpg'),
+        ('scratch/renditions/256/alice/img1.jpg', 'renditions/256/alice/img1.jpg')
+    ]
+    assert pipeline.s3.objects[('primary', 'alice/img1.jpg')] == parked
+    fields = pipeline.publish_image.call_args.args[4]
+    assert (fields['size'], fields['attempts']) == (1234, 2)
+    assert {'scratch/alice/img1.jpg', 'scratch/renditions/256/alice/img1.jpg'} <= set(pipeline.s3.deleted)
+    pipeline.handle_processing_failure.assert_not_called()
+
+
+def test_retry_resumes_from_the_checkpoint_saved_on_the_row(process_app, pipeline):
+    # the message lost its checkpoint, the claim returns the one on the row
+    pipeline.claim_image.return_value = ('token', 2, rendered_checkpoint('publish'))
+
+    process_app.process_image('staging', 'alice/img1.jpg', 2)
+
+    assert pipeline.s3.downloads == []
+    assert pipeline.s3.copies == []
+    pipeline.publish_image.assert_called_once()
+    pipeline.save_content_hash.assert_called_once()
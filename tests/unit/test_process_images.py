@@ -0,0 +1,276 @@
+import io
+
+import pytest
+from PIL import ExifTags, Image, ImageChops, ImageCms, ImageDraw
+
+
+def encoded(image, image_format='PNG', **options):
+    output = io.BytesIO()
+    image.save(output, image_format, **options)
+    output.seek(0)
+    return output
+
+
+def decoded(data):
+    return Image.open(io.BytesIO(data))
+
+
+def test_name_line_is_rendered_once_per_user(process_app):
+    process_app.get_name_tile.cache_clear()
+    for _ in range(3):
+        process_app.add_watermark(encoded(Image.new('RGB', (1600, 1200), (40, 90, 200))), 'alice')
+    process_app.add_watermark(encoded(Image.new('RGB', (1600, 1200), (40, 90, 200))), 'bob')
+
+    cache = process_app.get_name_tile.cache_info()
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_watermark_lines_match_multiline_text(process_app):
+    # the cached name and the per image time line together draw exactly what
+    # one multiline text call would
+    font_size = 120
+    expected = Image.new('RGBA', (1600, 600), (0, 0, 0, 0))
+    ImageDraw.Draw(expected).multiline_text(
+        (100, 100),
+        'alice\n2026-10-17 10:00:00',
+        font=process_app.get_font(font_size),
+        fill=process_app.WATERMARK_TEXT_COLOR,
+        stroke_fill=process_app.WATERMARK_STROKE_COLOR,
+        stroke_width=process_app.WATERMARK_STROKE_WIDTH
+    )
+
+    actual = Image.new('RGBA', expected.size, (0, 0, 0, 0))
+    lines = [
+        (process_app.get_name_tile(font_size, 'alice'), 0),
+        (process_app.render_text_tile(font_size, '2026-10-17 10:00:00'), process_app.get_line_height(font_size))
+    ]
+    for (tile, (offset_x, offset_y), _), line_y in lines:
+        process_app.composite_tile(actual, tile, 100 + offset_x, 100 + line_y + offset_y)
+
+    assert ImageChops.difference(expected, actual).getbbox() is None
+
+
+def test_watermark_only_touches_the_text_region(process_app):
+    source = Image.new('RGB', (1600, 1200), (40, 90, 200))
+
+    output, _, output_format = process_app.add_watermark(encoded(source), 'alice')
+    watermarked = decoded(output).convert('RGB')
+
+    assert output_format == 'PNG'
+    changed = ImageChops.difference(source, watermarked).getbbox()
+    assert changed is not None
+    left, top, right, bottom = changed
+    # centred, the corners keep the original pixels
+    assert 0 < left < 800 < right < 1600
+    assert 0 < top < 600 < bottom < 1200
+
+
+def test_composite_tile_clips_at_the_frame(process_app):
+    base = Image.new('RGB', (10, 10), (0, 0, 0))
+    tile = Image.new('RGBA', (6, 6), (255, 255, 255, 255))
+
+    process_app.composite_tile(base, tile, -3, 7)
+
+    assert ImageChops.difference(base, Image.new('RGB', (10, 10))).getbbox() == (0, 7, 3, 10)
+
+
+def test_renditions_fit_the_longest_edge(process_app):
+    image = Image.new('RGB', (3000, 2000), (200, 30, 30))
+
+    renditions = process_app.make_renditions(image, [400, 1600, 400, 1200], 'PNG')
+
+    assert list(renditions) == [1600, 1200, 400]
+    assert decoded(renditions[1600]).size == (1600, 1067)
+    assert decoded(renditions[1200]).size == (1200, 800)
+    assert decoded(renditions[400]).size == (400, 267)
+    assert image.size == (3000, 2000)
+
+
+def test_renditions_never_scale_up(process_app):
+    image = Image.new('RGB', (800, 1000))
+
+    renditions = process_app.make_renditions(image, [2000, 1000, 600], 'PNG')
+
+    assert list(renditions) == [600]
+    assert decoded(renditions[600]).size == (480, 600)
+
+
+def test_renditions_are_made_from_the_watermarked_frame(process_app):
+    source = Image.new('RGB', (1600, 1200), (40, 90, 200))
+
+    _, renditions, _ = process_app.add_watermark(encoded(source), 'alice', rendition_sizes=(400,))
+
+    rendition = decoded(renditions[400]).convert('RGB')
+    assert rendition.size == (400, 300)
+    assert ImageChops.difference(rendition, source.resize((400, 300))).getbbox() is not None
+
+
+def test_rendition_key(process_app):
+    assert process_app.rendition_key(400, 'users/alice/cat.jpg') == 'renditions/400/users/alice/cat.jpg'
+
+
+def codecs(monkeypatch, process_app, output_format, available=('webp', 'avif')):
+    monkeypatch.setattr(process_app, 'OUTPUT_FORMAT', output_format)
+    monkeypatch.setattr(process_app.features, 'check', lambda feature: feature in available)
+
+
+def test_original_format_is_kept_by_default(monkeypatch, process_app):
+    codecs(monkeypatch, process_app, 'ORIGINAL')
+
+    assert process_app.get_output_format('PNG', (4000, 3000)) == 'PNG'
+    assert process_app.get_output_format('MPO', (4000, 3000)) == 'JPEG'
+
+
+def test_webp_output(monkeypatch, process_app):
+    codecs(monkeypatch, process_app, 'WEBP')
+
+    assert process_app.get_output_format('JPEG', (4000, 3000)) == 'WEBP'
+    assert process_app.get_output_format('JPEG', (16383, 2000)) == 'WEBP'
+
+
+def test_panorama_over_the_webp_limit_falls_back(monkeypatch, process_app):
+    codecs(monkeypatch, process_app, 'WEBP')
+    assert process_app.get_output_format('MPO', (20000, 2000)) == 'AVIF'
+
+    codecs(monkeypatch, process_app, 'WEBP', available=('webp',))
+    assert process_app.get_output_format('MPO', (20000, 2000)) == 'JPEG'
+
+
+def test_avif_output_needs_the_codec(monkeypatch, process_app):
+    codecs(monkeypatch, process_app, 'AVIF')
+    assert process_app.get_output_format('JPEG', (20000, 2000)) == 'AVIF'
+
+    codecs(monkeypatch, process_app, 'AVIF', available=('webp',))
+    assert process_app.get_output_format('JPEG', (4000, 3000)) == 'WEBP'
+    assert process_app.get_output_format('JPEG', (20000, 2000)) == 'JPEG'
+
+    codecs(monkeypatch, process_app, 'AVIF', available=())
+    assert process_app.get_output_format('PNG', (4000, 3000)) == 'PNG'
+
+
+def test_phone_jpeg_is_saved_as_jpeg(monkeypatch, process_app):
+    codecs(monkeypatch, process_app, 'ORIGINAL')
+    frame = Image.new('RGB', (1600, 1200), (40, 90, 200))
+    source = encoded(frame, 'MPO', save_all=True, append_images=[frame])
+    assert Image.open(source).format == 'MPO'
+    source.seek(0)
+
+    output, _, output_format = process_app.add_watermark(source, 'alice')
+
+    assert output_format == 'JPEG'
+    assert decoded(output).format == 'JPEG'
+
+
+def camera_exif(orientation=1):
+    exif = Image.Exif()
+    exif[ExifTags.Base.Make] = 'Canon'
+    exif[ExifTags.Base.Model] = 'EOS R5'
+    exif[ExifTags.Base.Orientation] = orientation
+    exif.get_ifd(ExifTags.IFD.Exif).update({
+        ExifTags.Base.DateTimeOriginal: '2026:10:17 10:00:00',
+        ExifTags.Base.BodySerialNumber: '012345678901',
+        ExifTags.Base.LensSerialNumber: '9876543210',
+        ExifTags.Base.CameraOwnerName: 'Alice Example'
+    })
+    exif.get_ifd(ExifTags.IFD.GPSInfo).update({
+        ExifTags.GPS.GPSLatitudeRef: 'N',
+        ExifTags.GPS.GPSLatitude: (5.0, 36.0, 12.0)
+    })
+    return exif
+
+
+def test_location_and_serial_numbers_are_stripped(process_app):
+    source = encoded(Image.new('RGB', (1600, 1200), (40, 90, 200)), 'JPEG', exif=camera_exif())
+    assert Image.open(source).getexif().get_ifd(ExifTags.IFD.GPSInfo)
+    source.seek(0)
+
+    output, _, _ = process_app.add_watermark(source, 'alice')
+
+    exif = decoded(output).getexif()
+    assert ExifTags.IFD.GPSInfo not in exif
+    assert not exif.get_ifd(ExifTags.IFD.GPSInfo)
+    exif_ifd = exif.get_ifd(ExifTags.IFD.Exif)
+    for tag in process_app.PRIVATE_EXIF_TAGS:
+        assert tag not in exif_ifd
+    # the rest of the camera data is kept
+    assert exif[ExifTags.Base.Make] == 'Canon'
+    assert exif[ExifTags.Base.Model] == 'EOS R5'
+    assert exif_ifd[ExifTags.Base.DateTimeOriginal] == '2026:10:17 10:00:00'
+
+
+def test_rotated_photo_is_saved_upright(process_app):
+    # orientation 6, the camera was held on its side
+    source = encoded(Image.new('RGB', (1600, 1200), (40, 90, 200)), 'JPEG', exif=camera_exif(orientation=6))
+
+    output, _, _ = process_app.add_watermark(source, 'alice')
+
+    saved = decoded(output)
+    assert saved.size == (1200, 1600)
+    assert saved.getexif().get(ExifTags.Base.Orientation, 1) == 1
+
+
+def test_opaque_image_keeps_its_colour_profile(process_app):
+    profile = ImageCms.ImageCmsProfile(ImageCms.createProfile('sRGB')).tobytes()
+    source = encoded(Image.new('RGB', (1600, 1200), (40, 90, 200)), 'JPEG', icc_profile=profile)
+
+    output, _, _ = process_app.add_watermark(source, 'alice')
+
+    saved = decoded(output)
+    assert saved.mode == 'RGB'
+    assert saved.info['icc_profile'] == profile
+
+
+def test_transparent_image_is_flattened(process_app):
+    source = Image.new('RGBA', (1600, 1200), (40, 90, 200, 0))
+
+    output, _, output_format = process_app.add_watermark(encoded(source), 'alice')
+
+    assert output_format == 'PNG'
+    assert decoded(output).mode == 'RGB'
+
+
+def test_pixel_budget(process_app):
+    process_app.check_pixel_budget('PNG', (1000, 1000), 1000 * 1000)
+    process_app.check_pixel_budget('PNG', None, 1000 * 1000)
+    with pytest.raises(process_app.ImageTooLargeError):
+        process_app.check_pixel_budget('PNG', (1001, 1000), 1000 * 1000)
+
+
+def test_jpeg_can_be_drafted_into_the_pixel_budget(process_app):
+    # up to 1/8 scale on decode, 64 times the budget
+    process_app.check_pixel_budget('JPEG', (8000, 8000), 1000 * 1000)
+    with pytest.raises(process_app.ImageTooLargeError) as error:
+        process_app.check_pixel_budget('JPEG', (8001, 8000), 1000 * 1000)
+    assert error.value.reason == 'too_large'
+
+
+def test_jpeg_is_decoded_at_a_reduced_scale(process_app):
+    image = Image.open(encoded(Image.new('RGB', (4000, 3000), (40, 90, 200)), 'JPEG'))
+
+    # 12 megapixels into 1, a quarter of each edge is the first scale that fits
+    drafted = process_app.draft_to_budget(image, 1000 * 1000)
+
+    assert drafted.size == (1000, 750)
+    drafted.load()
+    assert drafted.size == (1000, 750)
+
+
+def test_image_within_the_budget_is_not_drafted(process_app):
+    image = Image.open(encoded(Image.new('RGB', (1000, 750)), 'JPEG'))
+
+    assert process_app.draft_to_budget(image, 1000 * 1000).size == (1000, 750)
+
+
+def test_image_that_cannot_be_drafted_is_too_large(process_app):
+    image = Image.open(encoded(Image.new('RGB', (2000, 2000))))
+
+    with pytest.raises(process_app.ImageTooLargeError):
+        process_app.draft_to_budget(image, 1000 * 1000)
+
+
+def test_large_jpeg_is_watermarked_at_the_drafted_size(process_app):
+    source = encoded(Image.new('RGB', (4000, 3000), (40, 90, 200)), 'JPEG')
+
+    output, _, _ = process_app.add_watermark(source, 'alice', max_pixels=1000 * 1000)
+
+    assert decoded(output).size == (1000, 750)
@@ -0,0 +1,173 @@
+import json
+from unittest import mock
+
+import pytest
+
+
+class TransactionCanceled(Exception):
+    pass
+
+
+class FakeTable:
+    # rows by their sort key, get_item reads them, every write is a mock
+    def __init__(self, name, key_name, items=()):
+        self.name = name
+        self.key_name = key_name
+        self.items = {item[key_name]: item for item in items}
+        self.delete_item = mock.Mock()
+        self.update_item = mock.Mock()
+
+    def get_item(self, Key, ConsistentRead=False):
+        item = self.items.get(Key[self.key_name])
+        return {'Item': item} if item else {}
+
+
+def image(image_id, **fields):
+    return {'user_id': 'alice', 'image_id': image_id, 's3Key': 'alice/orig.jpg', 'deletion_mode': 'none', **fields}
+
+
+def purge_message(image_id='orig', **fields):
+    return {
+        'user_id': 'alice',
+        'image_id': image_id,
+        'content_hash': 'abc',
+        's3_keys': ['alice/orig.jpg', 'renditions/256/alice/orig.jpg'],
+        **fields
+    }
+
+
+@pytest.fixture()
+def client(purge_app, monkeypatch):
+    dynamodb = mock.Mock()
+    dynamodb.meta.client.exceptions.TransactionCanceledException = TransactionCanceled
+    monkeypatch.setattr(purge_app, 'dynamodb', dynamodb)
+    return dynamodb.meta.client
+
+
+def hash_entry(**fields):
+    return FakeTable('hashes', 'content_hash', [{'user_id': 'alice', 'content_hash': 'abc', 'image_id': 'orig', **fields}])
+
+
+def test_duplicate_takes_over_the_objects(purge_app, client):
+    table = FakeTable('images', 'image_id', [
+        image('dup1', duplicate_of='orig'),
+        image('dup2', duplicate_of='orig')
+    ])
+    hash_table = hash_entry(duplicates={'dup1', 'dup2'}, ref_version=2)
+
+    assert purge_app.hand_over_objects(table, hash_table, purge_message()) is True
+
+    items = client.transact_write_items.call_args.kwargs['TransactItems']
+    assert items[0]['Update']['ExpressionAttributeValues'][':new_owner'] == 'dup1'
+    assert items[1]['Update']['Key'] == {'user_id': 'alice', 'image_id': 'dup1'}
+    # the other duplicate now points at the new owner
+    table.update_item.assert_called_once()
+    update = table.update_item.call_args.kwargs
+    assert update['Key']['image_id'] == 'dup2'
+    assert update['ExpressionAttributeValues'] == {':new_owner': 'dup1'}
+    hash_table.delete_item.assert_not_called()
+
+
+def test_duplicates_being_deleted_or_gone_are_skipped(purge_app, client):
+    table = FakeTable('images', 'image_id', [
+        image('dup1', duplicate_of='orig', deletion_mode='pending_delete'),
+        image('dup3', duplicate_of='orig')
+    ])
+    hash_table = hash_entry(duplicates={'dup1', 'dup2', 'dup3'})
+
+    assert purge_app.hand_over_objects(table, hash_table, purge_message()) is True
+
+    assert client.transact_write_items.call_count == 1
+    items = client.transact_write_items.call_args.kwargs['TransactItems']
+    assert items[0]['Update']['ExpressionAttributeValues'][':new_owner'] == 'dup3'
+
+
+def test_duplicate_that_changed_while_taking_over_is_passed_over(purge_app, client):
+    table = FakeTable('images', 'image_id', [image('dup1', duplicate_of='orig'), image('dup2', duplicate_of='orig')])
+    client.transact_write_items.side_effect = [TransactionCanceled(), None]
+
+    assert purge_app.hand_over_objects(table, hash_entry(duplicates={'dup1', 'dup2'}), purge_message()) is True
+
+    owners = [call.kwargs['TransactItems'][0]['Update']['ExpressionAttributeValues'][':new_owner']
+              for call in client.transact_write_items.call_args_list]
+    assert owners == ['dup1', 'dup2']
+
+
+def test_without_duplicates_the_hash_entry_is_deleted_first(purge_app, client):
+    table = FakeTable('images', 'image_id')
+    hash_table = hash_entry(ref_version=3)
+
+    assert purge_app.hand_over_objects(table, hash_table, purge_message()) is False
+
+    client.transact_write_items.assert_not_called()
+    delete = hash_table.delete_item.call_args.kwargs
+    assert delete['Key'] == {'user_id': 'alice', 'content_hash': 'abc'}
+    assert delete['ExpressionAttributeValues'] == {':image_id': 'orig', ':ref_version': 3}
+
+
+def test_image_without_a_hash_entry_deletes_its_objects(purge_app, client):
+    hash_table = FakeTable('hashes', 'content_hash')
+
+    assert purge_app.hand_over_objects(FakeTable('images', 'image_id'), hash_table, purge_message()) is False
+
+
+def test_retry_finds_the_objects_already_handed_over(purge_app, client):
+    table = FakeTable('images', 'image_id', [image('dup1')])
+
+    assert purge_app.hand_over_objects(table, hash_entry(image_id='dup1'), purge_message()) is True
+
+    client.transact_write_items.assert_not_called()
+
+
+def test_hash_entry_of_other_objects_is_not_a_hand_over(purge_app, client):
+    # the entry was deleted and a later upload with its own objects took the hash
+    table = FakeTable('images', 'image_id', [image('new', s3Key='alice/new.jpg')])
+
+    assert purge_app.hand_over_objects(table, hash_entry(image_id='new'), purge_message()) is False
+
+
+def test_handed_over_objects_are_not_deleted(purge_app, image_records, client, monkeypatch):
+    monkeypatch.setenv('PROCESSED_BUCKET', 'primary')
+    monkeypatch.setenv('USER_IMAGES_TABLE', 'images')
+    monkeypatch.setenv('IMAGE_SHARING_TABLE', 'shares')
+    monkeypatch.setenv('IMAGE_HASH_TABLE', 'hashes')
+    monkeypatch.setattr(purge_app, 'hand_over_objects', lambda table, hash_table, message: message['image_id'] == 'orig')
+    monkeypatch.setattr(purge_app, 'get_image_share_tokens', lambda table, user_id, image_id: [])
+    monkeypatch.setattr(purge_app, 's3', mock.Mock())
+    purge_app.s3.delete_objects.return_value = {}
+    monkeypatch.setattr(image_records, 'dynamodb', mock.Mock())
+    image_records.dynamodb.meta.client.batch_write_item.return_value = {}
+
+    records = [
+        {'messageId': 'm1', 'body': json.dumps(purge_message())},
+        {'messageId': 'm2', 'body': json.dumps(purge_message('other', s3_keys=['alice/other.jpg']))}
+    ]
+    response = purge_app.lambda_handler({'Records': records}, None)
+
+    assert response == {'batchItemFailures': []}
+    deleted = purge_app.s3.delete_objects.call_args.kwargs['Delete']['Objects']
+    assert deleted == [{'Key': 'alice/other.jpg'}]
+    requests = image_records.dynamodb.meta.client.batch_write_item.call_args.kwargs['RequestItems']['images']
+    assert [request['DeleteRequest']['Key']['image_id'] for request in requests] == ['orig', 'other']
+
+
+def test_image_queued_twice_is_deleted_once(purge_app, image_records, client, monkeypatch):
+    # a redelivered message, or a bulk delete racing the sweeper
+    monkeypatch.setenv('PROCESSED_BUCKET', 'primary')
+    monkeypatch.setenv('USER_IMAGES_TABLE', 'images')
+    monkeypatch.setenv('IMAGE_SHARING_TABLE', 'shares')
+    monkeypatch.delenv('IMAGE_HASH_TABLE', raising=False)
+    monkeypatch.setattr(purge_app, 'get_image_share_tokens', lambda table, user_id, image_id: ['share1', 'share2'])
+    monkeypatch.setattr(purge_app, 's3', mock.Mock())
+    purge_app.s3.delete_objects.return_value = {}
+    monkeypatch.setattr(image_records, 'dynamodb', mock.Mock())
+    image_records.dynamodb.meta.client.batch_write_item.return_value = {}
+
+    records = [{'messageId': message_id, 'body': json.dumps(purge_message())} for message_id in ('m1', 'm2')]
+    response = purge_app.lambda_handler({'Records': records}, None)
+
+    assert response == {'batchItemFailures': []}
+    assert len(purge_app.s3.delete_objects.call_args.kwargs['Delete']['Objects']) == 2
+    shares, images = [call.kwargs['RequestItems'] for call in image_records.dynamodb.meta.client.batch_write_item.call_args_list]
+    assert [request['DeleteRequest']['Key'] for request in shares['shares']] == [{'share_token': 'share1'}, {'share_token': 'share2'}]
+    assert [request['DeleteRequest']['Key'] for request in images['images']] == [{'user_id': 'alice', 'image_id': 'orig'}]
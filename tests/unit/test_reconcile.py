@@ -0,0 +1,178 @@
+import json
+from unittest import mock
+
+import pytest
+
+
+class ParameterNotFound(Exception):
+    pass
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+class FakeSSM:
+    def __init__(self):
+        self.parameters = {}
+        self.exceptions = mock.Mock(ParameterNotFound=ParameterNotFound)
+
+    def get_parameter(self, Name):
+        if Name not in self.parameters:
+            raise ParameterNotFound(Name)
+        return {'Parameter': {'Value': self.parameters[Name]}}
+
+    def put_parameter(self, Name, Value, Type, Overwrite):
+        self.parameters[Name] = Value
+
+
+class FakeTable:
+    # the scan hands out one page per call, keyed by where the page starts
+    def __init__(self, pages):
+        self.pages = pages
+        self.scans = []
+        self.update_item = mock.Mock()
+        self.meta = mock.Mock()
+        self.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailed
+
+    def scan(self, **kwargs):
+        start = kwargs.get('ExclusiveStartKey', {}).get('image_id')
+        self.scans.append(start)
+        index = 0 if start is None else int(start) + 1
+        response = {'Items': self.pages[index]}
+        if index + 1 < len(self.pages):
+            response['LastEvaluatedKey'] = {'user_id': 'alice', 'image_id': str(index)}
+        return response
+
+
+def image(image_id, **fields):
+    return {
+        'user_id': 'alice',
+        'image_id': image_id,
+        's3Key': f'alice/{image_id}.jpg',
+        'status': 'water-marked',
+        'deletion_mode': 'none',
+        'user_deletion_mode': 'alice#none',
+        **fields
+    }
+
+
+def lambda_context(*remaining_millis):
+    context = mock.Mock()
+    context.get_remaining_time_in_millis.side_effect = list(remaining_millis)
+    return context
+
+
+@pytest.fixture()
+def reconcile(reconcile_app, monkeypatch):
+    monkeypatch.setenv('USER_IMAGES_TABLE', 'images')
+    monkeypatch.setenv('PROCESSED_BUCKET', 'primary')
+    monkeypatch.setenv('RECONCILE_STATE_PARAMETER', '/stack/reconcile-state')
+    monkeypatch.setenv('BACKFILL_STATUS_PARAMETER', '/stack/backfill-status')
+    monkeypatch.setattr(reconcile_app, 'ssm', FakeSSM())
+    monkeypatch.setattr(reconcile_app, 'dynamodb', mock.Mock())
+    # every image still has its object
+    monkeypatch.setattr(reconcile_app, 'list_user_objects', lambda bucket, user_id: {f'alice/{i}.jpg' for i in range(10)})
+
+    def run(pages, context=None):
+        table = FakeTable(pages)
+        reconcile_app.dynamodb.Table.return_value = table
+        summary = json.loads(reconcile_app.lambda_handler({}, context)['body'])
+        return table, summary
+
+    return run
+
+
+def state(reconcile_app):
+    return json.loads(reconcile_app.ssm.parameters['/stack/reconcile-state'])
+
+
+def test_run_stops_between_pages_and_the_next_one_carries_on(reconcile_app, reconcile):
+    pages = [[image('0')], [image('1')], [image('2')]]
+
+    table, summary = reconcile(pages, lambda_context(reconcile_app.MIN_REMAINING_MILLIS - 1))
+
+    assert table.scans == [None]
+    assert summary['pass_complete'] is False
+    assert state(reconcile_app)['start_key'] == {'user_id': 'alice', 'image_id': '0'}
+
+    table, summary = reconcile(pages, lambda_context(10 * 60 * 1000))
+
+    assert table.scans == ['0', '1']
+    assert summary['checked'] == 2
+    assert summary['pass_complete'] is True
+    assert 'start_key' not in state(reconcile_app)
+
+
+def test_next_pass_waits_a_day(reconcile_app, reconcile):
+    pages = [[image('0')]]
+    reconcile(pages)
+    assert state(reconcile_app)['next_pass_at'] > 0
+
+    table, summary = reconcile(pages)
+
+    assert table.scans == []
+    assert summary == {'checked': 0}
+
+
+def test_rows_without_index_keys_are_backfilled(reconcile_app, reconcile, monkeypatch):
+    monkeypatch.setattr(reconcile_app.time, 'time', lambda: 1000000)
+    old = image('0', deletion_mode='soft')
+    del old['user_deletion_mode']
+    pages = [[old, image('1'), image('2', deletion_mode='pending_delete', user_deletion_mode='alice#pending_delete')]]
+
+    table, summary = reconcile(pages)
+
+    assert summary['backfilled'] == 1
+    update = table.update_item.call_args.kwargs
+    assert update['Key'] == {'user_id': 'alice', 'image_id': '0'}
+    assert update['ConditionExpression'] == 'deletion_mode = :mode'
+    values = update['ExpressionAttributeValues']
+    assert values[':key'] == 'alice#soft'
+    # soft deleted before the sweeper, it is purged after a full retention period from now
+    assert values[':soft_deleted'] == 'true'
+    assert values[':purge_at'] == 1000000 + reconcile_app.SOFT_DELETE_RETENTION_DAYS * 24 * 60 * 60
+
+
+def test_soft_row_missing_from_the_sweeper_index_is_backfilled(reconcile_app, reconcile):
+    table, summary = reconcile([[image('0', deletion_mode='soft', user_deletion_mode='alice#soft')]])
+
+    assert summary['backfilled'] == 1
+    assert 'purge_at = if_not_exists(purge_at, :purge_at)' in table.update_item.call_args.kwargs['UpdateExpression']
+
+
+def test_backfill_is_complete_after_a_pass_without_failures(reconcile_app, reconcile):
+    old = image('0')
+    del old['user_deletion_mode']
+
+    reconcile([[old]])
+
+    assert reconcile_app.ssm.parameters['/stack/backfill-status'] == 'complete'
+
+
+def test_row_changed_since_the_scan_is_not_a_failure(reconcile_app, reconcile, monkeypatch):
+    old = image('0')
+    del old['user_deletion_mode']
+    monkeypatch.setattr(reconcile_app, 'backfill_deletion_mode', mock.Mock(side_effect=ConditionalCheckFailed()))
+
+    _, summary = reconcile([[old]])
+
+    assert summary['backfill_failed'] == 0
+    assert reconcile_app.ssm.parameters['/stack/backfill-status'] == 'complete'
+
+
+def test_failure_in_any_run_of_the_pass_keeps_the_backfill_incomplete(reconcile_app, reconcile, monkeypatch):
+    old = image('0')
+    del old['user_deletion_mode']
+    pages = [[old], [image('1')]]
+    backfill = mock.Mock(side_effect=[RuntimeError("throttled")])
+    monkeypatch.setattr(reconcile_app, 'backfill_deletion_mode', backfill)
+
+    reconcile(pages, lambda_context(0))
+    assert state(reconcile_app)['backfill_failed'] == 1
+
+    _, summary = reconcile(pages, lambda_context(10 * 60 * 1000))
+
+    assert summary['pass_complete'] is True
+    assert summary['backfill_failed'] == 1
+    assert '/stack/backfill-status' not in reconcile_app.ssm.parameters
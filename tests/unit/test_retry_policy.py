@@ -0,0 +1,80 @@
+import io
+
+import pytest
+from botocore.exceptions import ClientError, EndpointConnectionError
+from PIL import Image
+
+
+def client_error(code, status=400):
+    return ClientError({'Error': {'Code': code}, 'ResponseMetadata': {'HTTPStatusCode': status}}, 'GetObject')
+
+
+def pillow_error(data):
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image.load()
+    except Exception as e:
+        return e
+    raise AssertionError("Pillow read the image")
+
+
+def truncated_jpeg():
+    output = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 30, 30)).save(output, 'JPEG')
+    return output.getvalue()[:200]
+
+
+def test_throttling_is_transient(retry_policy):
+    assert retry_policy.classify_error(client_error('SlowDown', 503)) == (retry_policy.TRANSIENT, 'throttled:SlowDown')
+
+
+def test_server_error_is_transient(retry_policy):
+    assert retry_policy.classify_error(client_error('InternalError', 500)) == (retry_policy.TRANSIENT, 'server_error:InternalError')
+
+
+def test_client_error_is_permanent(retry_policy):
+    assert retry_policy.classify_error(client_error('NoSuchKey', 404)) == (retry_policy.PERMANENT, 'client_error:NoSuchKey')
+
+
+def test_network_error_is_transient(retry_policy):
+    kind, reason = retry_policy.classify_error(EndpointConnectionError(endpoint_url='https://s3.amazonaws.com'))
+    assert (kind, reason) == (retry_policy.TRANSIENT, 'network:EndpointConnectionError')
+
+
+def test_permanent_processing_error_keeps_its_reason(retry_policy):
+    class TooLarge(retry_policy.PermanentProcessingError):
+        reason = 'too_large'
+
+    assert retry_policy.classify_error(TooLarge()) == (retry_policy.PERMANENT, 'too_large')
+
+
+def test_unreadable_image_is_permanent(retry_policy):
+    assert retry_policy.classify_error(pillow_error(b'not an image')) == (retry_policy.PERMANENT, 'unsupported_image')
+
+
+def test_pillow_decode_error_is_permanent(retry_policy):
+    error = pillow_error(truncated_jpeg())
+    assert retry_policy.classify_error(error) == (retry_policy.PERMANENT, f"decode_error:{type(error).__name__}")
+
+
+def test_disk_full_is_transient(retry_policy):
+    try:
+        raise OSError(28, 'No space left on device')
+    except OSError as e:
+        error = e
+    assert retry_policy.classify_error(error)[0] == retry_policy.TRANSIENT
+
+
+def test_value_error_outside_pillow_is_transient(retry_policy):
+    try:
+        int('abc')
+    except ValueError as e:
+        error = e
+    assert retry_policy.classify_error(error) == (retry_policy.TRANSIENT, 'unknown:ValueError')
+
+
+@pytest.mark.parametrize('attempt', [1, 2, 3, 10])
+def test_backoff_delay_stays_within_bounds(retry_policy, attempt):
+    ceiling = min(retry_policy.MAX_DELAY_SECONDS, retry_policy.BASE_DELAY_SECONDS * 2 ** (attempt - 1))
+    for _ in range(50):
+        assert 0 <= retry_policy.backoff_delay(attempt) <= ceiling
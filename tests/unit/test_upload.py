@@ -0,0 +1,69 @@
+import json
+from decimal import Decimal
+from unittest import mock
+
+import pytest
+
+
+class ConditionalCheckFailed(Exception):
+    pass
+
+
+@pytest.fixture()
+def multipart(upload_app, monkeypatch):
+    # an upload of 3 parts, S3 has received two of them
+    monkeypatch.setenv('USER_TABLE', 'images')
+    monkeypatch.setenv('STAGE_BUCKET', 'staging')
+    table = mock.Mock()
+    table.meta.client.exceptions.ConditionalCheckFailedException = ConditionalCheckFailed
+    table.get_item.return_value = {'Item': {
+        'user_id': 'alice',
+        'image_id': 'img1',
+        'status': 'uploading',
+        'upload_id': 'upload1',
+        's3Key': 'alice/img1.jpg',
+        'size': Decimal(20 * 1024 * 1024),
+        'total_parts': Decimal(3)
+    }}
+    monkeypatch.setattr(upload_app, 'dynamodb', mock.Mock())
+    upload_app.dynamodb.Table.return_value = table
+    s3 = mock.Mock()
+    s3.get_paginator.return_value.paginate.return_value = [
+        {'Parts': [{'PartNumber': 1, 'Size': 8 * 1024 * 1024}]},
+        {'Parts': [{'PartNumber': 2, 'Size': 8 * 1024 * 1024}]}
+    ]
+    monkeypatch.setattr(upload_app, 's3', s3)
+    return table
+
+
+def test_progress_comes_from_the_parts_s3_received(upload_app, multipart):
+    response = upload_app.get_multipart_progress('alice', 'img1')
+
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {
+        'imageId': 'img1',
+        'size': 20 * 1024 * 1024,
+        'totalParts': 3,
+        'partsUploaded': 2,
+        'bytesUploaded': 16 * 1024 * 1024
+    }
+    upload_app.s3.get_paginator.return_value.paginate.assert_called_once_with(
+        Bucket='staging', Key='alice/img1.jpg', UploadId='upload1'
+    )
+    values = multipart.update_item.call_args.kwargs['ExpressionAttributeValues']
+    assert (values[':parts'], values[':bytes']) == (2, 16 * 1024 * 1024)
+
+
+def test_progress_of_a_finished_upload_is_not_recorded(upload_app, multipart):
+    multipart.update_item.side_effect = ConditionalCheckFailed()
+
+    upload_app.record_progress('alice', 'img1', {1: 100})
+
+    assert multipart.update_item.call_args.kwargs['ConditionExpression'] == '#status = :uploading'
+
+
+def test_progress_of_an_unknown_upload(upload_app, multipart):
+    multipart.get_item.return_value = {'Item': {'user_id': 'alice', 'image_id': 'img1', 'status': 'processing'}}
+
+    assert upload_app.get_multipart_progress('alice', 'img1')['statusCode'] == 404
+    upload_app.s3.get_paginator.assert_not_called()
@@ -0,0 +1,187 @@
+import json
+from unittest import mock
+
+import pytest
+
+
+class FakeTable:
+    # hands out the scripted query responses in order and keeps the calls
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.queries = []
+
+    def query(self, **kwargs):
+        self.queries.append(dict(kwargs))
+        return self.responses.pop(0)
+
+
+def image(image_id):
+    return {'user_id': 'user-1', 'image_id': image_id, 's3Key': f'user-1/{image_id}.jpg', 'status': 'water-marked'}
+
+
+@pytest.fixture()
+def listing(view_app, monkeypatch):
+    # signing needs credentials, the listing itself is what is tested
+    monkeypatch.setattr(view_app, 'get_presigned_url', lambda key, expiration: f'https://signed/{key}')
+    monkeypatch.setattr(view_app, 'get_rendition_urls', lambda item, expiration: {})
+    return view_app
+
+
+def test_page_token_round_trip(view_app):
+    last_evaluated_key = {'user_id': 'user-1', 'image_id': 'image-1'}
+    token = view_app.encode_page_token(last_evaluated_key)
+    assert view_app.decode_page_token(token, 'user-1') == last_evaluated_key
+
+
+def test_page_token_of_another_user_is_rejected(view_app):
+    token = view_app.encode_page_token({'user_id': 'user-2', 'image_id': 'image-1'})
+    with pytest.raises(ValueError):
+        view_app.decode_page_token(token, 'user-1')
+
+
+def test_page_token_that_is_not_a_key_is_rejected(view_app):
+    token = view_app.encode_page_token(['user-1'])
+    with pytest.raises(ValueError):
+        view_app.decode_page_token(token, 'user-1')
+
+
+def test_malformed_page_token_is_rejected(view_app):
+    with pytest.raises(ValueError):
+        view_app.decode_page_token('not a token', 'user-1')
+
+
+def test_listing_reads_until_the_page_is_full(listing):
+    table = FakeTable([
+        {'Items': [image('a')], 'LastEvaluatedKey': {'user_id': 'user-1', 'image_id': 'a'}},
+        {'Items': [image('b'), image('c')], 'LastEvaluatedKey': {'user_id': 'user-1', 'image_id': 'c'}}
+    ])
+
+    response = listing.get_all_user_images('user-1', table, {'limit': '3'})
+    body = json.loads(response['body'])
+
+    assert response['statusCode'] == 200
+    assert [item['image_id'] for item in body['images']] == ['a', 'b', 'c']
+    # only what is still missing is asked for, so the last key is an exact resume point
+    assert [query['Limit'] for query in table.queries] == [3, 2]
+    assert table.queries[1]['ExclusiveStartKey'] == {'user_id': 'user-1', 'image_id': 'a'}
+    assert listing.decode_page_token(body['nextToken'], 'user-1') == {'user_id': 'user-1', 'image_id': 'c'}
+
+
+def test_listing_reads_only_the_listing_attributes(listing):
+    table = FakeTable([{'Items': [image('a')]}])
+
+    body = json.loads(listing.get_all_user_images('user-1', table)['body'])
+
+    assert body['nextToken'] is None
+    assert body['images'][0]['presignedUrl'] == 'https://signed/user-1/a.jpg'
+    projected = set(table.queries[0]['ExpressionAttributeNames'].values())
+    assert projected == set(listing.LISTING_ATTRIBUTES)
+    assert table.queries[0]['Limit'] == listing.DEFAULT_PAGE_SIZE
+
+
+def test_listing_resumes_from_the_page_token(listing):
+    table = FakeTable([{'Items': [image('d')]}])
+    token = listing.encode_page_token({'user_id': 'user-1', 'image_id': 'c'})
+
+    listing.get_all_user_images('user-1', table, {'next_token': token})
+
+    assert table.queries[0]['ExclusiveStartKey'] == {'user_id': 'user-1', 'image_id': 'c'}
+
+
+def test_listing_caps_the_page_size(listing):
+    table = FakeTable([{'Items': []}])
+
+    listing.get_all_user_images('user-1', table, {'limit': '100000'})
+
+    assert table.queries[0]['Limit'] == listing.MAX_PAGE_SIZE
+
+
+@pytest.mark.parametrize('query_params', [{'limit': 'many'}, {'next_token': 'not a token'}])
+def test_listing_rejects_invalid_pagination(listing, query_params):
+    table = mock.Mock()
+
+    response = listing.get_all_user_images('user-1', table, query_params)
+
+    assert response['statusCode'] == 400
+    table.query.assert_not_called()
+
+
+def test_missing_images_are_not_signed(listing):
+    missing = dict(image('a'), status='image_not_found')
+    table = FakeTable([{'Items': [missing]}])
+
+    body = json.loads(listing.get_all_user_images('user-1', table)['body'])
+
+    assert body['images'][0]['presignedUrl'] is None
+
+
+@pytest.fixture()
+def index_enabled(listing, monkeypatch):
+    monkeypatch.setattr(listing, 'DELETION_MODE_INDEX_ENABLED', True)
+    monkeypatch.setattr(listing, 'BACKFILL_STATUS_PARAMETER', '/stack/eu-west-1/deletion-mode-backfill')
+    monkeypatch.setattr(listing, 'backfill_status', {'complete': False, 'checked_at': 0})
+    ssm = mock.Mock()
+    monkeypatch.setattr(listing, 'ssm', ssm)
+    return ssm
+
+
+def backfill_status(value):
+    return {'Parameter': {'Value': value}}
+
+
+def test_page_token_round_trip_on_index(view_app):
+    last_evaluated_key = {'user_id': 'user-1', 'image_id': 'image-1', 'user_deletion_mode': 'user-1#soft'}
+    token = view_app.encode_page_token(last_evaluated_key)
+    assert view_app.decode_page_token(token, 'user-1', 'user-1#soft') == last_evaluated_key
+
+
+def test_page_token_of_another_deletion_mode_is_rejected(view_app):
+    token = view_app.encode_page_token({'user_id': 'user-1', 'image_id': 'image-1', 'user_deletion_mode': 'user-1#none'})
+    with pytest.raises(ValueError):
+        view_app.decode_page_token(token, 'user-1', 'user-1#soft')
+
+
+def test_index_not_used_until_it_is_deployed(listing, monkeypatch):
+    monkeypatch.setattr(listing, 'DELETION_MODE_INDEX_ENABLED', False)
+    table = FakeTable([{'Items': []}])
+
+    listing.get_all_user_images('user-1', table, {'deletion_mode': 'soft'})
+
+    assert 'IndexName' not in table.queries[0]
+    assert table.queries[0]['ExpressionAttributeValues'] == {':mode': 'soft'}
+
+
+def test_index_not_used_until_the_backfill_is_complete(listing, index_enabled):
+    index_enabled.get_parameter.side_effect = Exception('ParameterNotFound')
+    table = FakeTable([{'Items': []}, {'Items': []}])
+
+    listing.get_all_user_images('user-1', table)
+    listing.get_all_user_images('user-1', table)
+
+    assert all('IndexName' not in query for query in table.queries)
+    # a "not done yet" is trusted for a while instead of read on every listing
+    assert index_enabled.get_parameter.call_count == 1
+
+
+def test_index_used_once_the_backfill_is_complete(listing, index_enabled):
+    index_enabled.get_parameter.return_value = backfill_status('complete')
+    table = FakeTable([{'Items': [image('a')]}, {'Items': []}])
+
+    listing.get_all_user_images('user-1', table, {'deletion_mode': 'soft'})
+    listing.get_all_user_images('user-1', table)
+
+    assert table.queries[0]['IndexName'] == listing.DELETION_MODE_INDEX
+    assert 'FilterExpression' not in table.queries[0]
+    assert table.queries[0]['KeyConditionExpression'].get_expression()['values'][1] == 'user-1#soft'
+    assert table.queries[1]['KeyConditionExpression'].get_expression()['values'][1] == 'user-1#none'
+    assert index_enabled.get_parameter.call_count == 1
+
+
+def test_listing_all_deletion_modes_reads_the_table(listing, index_enabled):
+    index_enabled.get_parameter.return_value = backfill_status('complete')
+    table = FakeTable([{'Items': []}])
+
+    listing.get_all_user_images('user-1', table, {'deletion_mode': 'all'})
+
+    assert 'IndexName' not in table.queries[0]
+    assert table.queries[0]['ExpressionAttributeValues'] == {':pending': 'pending_delete'}